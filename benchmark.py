@@ -0,0 +1,434 @@
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is reported as None.
+    resource = None
+
+# Synthetic vocabulary, same token names as the EMOPIA dictionary.
+CHORD_QUALITIES = ["M", "m", "o", "+", "sus2", "sus4", "7", "M7", "m7", "o7", "/o7"]
+CHORD_ROOTS = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+
+STAGES = ["decode", "make_midi", "render", "library", "audio_time", "votes"]
+
+
+def synthetic_dictionary():
+    """(event2word, word2event) with the fields and token names of the real dictionary."""
+    events = {
+        "tempo": [0, "CONTI"] + [f"Tempo_{t}" for t in range(32, 228, 4)],
+        "chord": [0, "CONTI"] + [f"{r}_{q}" for r in CHORD_ROOTS for q in CHORD_QUALITIES] + ["N_N"],
+        "bar-beat": [0, "Bar"] + [f"Beat_{b}" for b in range(16)],
+        "type": ["EOS", "Emotion", "Metrical", "Note"],
+        "pitch": [0] + [f"Note_Pitch_{p}" for p in range(22, 108)],
+        "duration": [0] + [f"Note_Duration_{d * 120}" for d in range(17)],
+        "velocity": [0] + [f"Note_Velocity_{v}" for v in range(40, 128, 4)],
+        "emotion": [0] + [f"Emotion_Q{q}" for q in range(1, 5)],
+    }
+    event2word = {key: {event: i for i, event in enumerate(values)} for key, values in events.items()}
+    word2event = {key: {i: event for i, event in enumerate(values)} for key, values in events.items()}
+    return event2word, word2event
+
+
+def synthetic_song(dictionary, n_bars, rng):
+    """Compound word array of a valid song: emotion, then bars of beats and notes, then EOS."""
+    event2word, word2event = dictionary
+    types = event2word["type"]
+    words = [[0, 0, 0, types["Emotion"], 0, 0, 0, 1]]
+    for _ in range(n_bars):
+        words.append([event2word["tempo"]["CONTI"], event2word["chord"]["CONTI"], event2word["bar-beat"]["Bar"], types["Metrical"], 0, 0, 0, 0])
+        for beat in sorted(rng.choice(16, size=4, replace=False)):
+            words.append([
+                rng.integers(2, len(event2word["tempo"])),
+                rng.integers(2, len(event2word["chord"])),
+                event2word["bar-beat"][f"Beat_{beat}"],
+                types["Metrical"], 0, 0, 0, 0,
+            ])
+            for _ in range(rng.integers(1, 4)):
+                words.append([
+                    0, 0, 0, types["Note"],
+                    rng.integers(1, len(event2word["pitch"])),
+                    rng.integers(2, len(event2word["duration"])),
+                    rng.integers(1, len(event2word["velocity"])),
+                    0,
+                ])
+    words.append([0, 0, 0, types["EOS"], 0, 0, 0, 0])
+    return np.array(words)
+
+
+def write_fixture_mp3(path, seconds, sample_rate=44100):
+    """Write the first frame of a 128kbps MPEG-1 Layer III file with a Xing header.
+
+    Enough for header probing, the file is not decodable audio.
+    """
+    frame_size = 144 * 128000 // sample_rate
+    frames = int(seconds * sample_rate / 1152)
+    frame = bytearray(frame_size)
+    frame[0:4] = b"\xff\xfb\x90\x00"
+    frame[36:40] = b"Xing"
+    frame[40:44] = struct.pack(">I", 0x1)
+    frame[44:48] = struct.pack(">I", frames)
+    with open(path, "wb") as f:
+        f.write(frame)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def tiny_model(n_class, d_model, n_layer, n_head):
+    """Randomly initialized TransformerModel with smaller dimensions than the checkpoints."""
+    import models
+    # NOTE: TransformerModel reads its dimensions from module globals.
+    models.D_MODEL, models.N_LAYER, models.N_HEAD = d_model, n_layer, n_head
+    net = models.TransformerModel(n_class, is_training=False)
+    return net.eval()
+
+
+def bench_decode(args, fixtures):
+    import torch
+    from bot_utils.decoding import decode_batch
+    torch.manual_seed(args.seed)
+    dictionary = fixtures["dictionary"]
+    n_class = [len(values) for values in dictionary[0].values()]
+    start = time.perf_counter()
+    net = tiny_model(n_class, args.d_model, args.layers, args.heads)
+    init_seconds = time.perf_counter() - start
+
+    generator = torch.Generator().manual_seed(args.seed)
+    tokens = 0
+    start = time.perf_counter()
+    for first in range(0, args.songs, args.batch_size):
+        batch_size = min(args.batch_size, args.songs - first)
+        results = decode_batch(net, dictionary, batch_size, max_tokens=args.max_tokens, generator=generator)
+        # A random model rarely reaches EOS, unfinished songs ran for max_tokens words.
+        tokens += sum(args.max_tokens if res is None else len(res) for res in results)
+    seconds = time.perf_counter() - start
+    return {
+        "model_init_seconds": init_seconds,
+        "seconds": seconds,
+        "tokens": tokens,
+        "tokens_per_sec": tokens / seconds,
+        "songs_per_sec": args.songs / seconds,
+    }
+
+
+def midi_contents(midi_obj):
+    """Notes, tempo changes and markers of a midi object as plain tuples."""
+    return (
+        [[(n.start, n.end, n.pitch, n.velocity) for n in inst.notes] for inst in midi_obj.instruments],
+        [(t.time, t.tempo) for t in midi_obj.tempo_changes],
+        [(m.time, m.text) for m in midi_obj.markers],
+    )
+
+
+def bench_make_midi(args, fixtures):
+    from bot_utils.midi_decoder import words_to_midi
+    word2event = fixtures["dictionary"][1]
+    mid_dir = os.path.join(fixtures["dir"], "midi")
+    os.makedirs(mid_dir, exist_ok=True)
+    start = time.perf_counter()
+    midi_objs = [words_to_midi(song, word2event) for song in fixtures["songs"]]
+    make_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    mid_paths = []
+    for i, midi_obj in enumerate(midi_objs):
+        mid_path = os.path.join(mid_dir, f"song{i:05d}.mid")
+        midi_obj.dump(mid_path)
+        mid_paths.append(mid_path)
+    dump_seconds = time.perf_counter() - start
+    fixtures["midi_objs"] = midi_objs
+    fixtures["mid_paths"] = mid_paths
+    # Songs rendered from memory must be timed as the same song rendered from its midi file.
+    from miditoolkit.midi.parser import MidiFile
+    from bot_utils.renderer import midi_events
+    render_timing_equal = all(
+        np.allclose([e[0] for e in midi_events(midi_obj)[1]], [e[0] for e in midi_events(MidiFile(mid_path))[1]])
+        for midi_obj, mid_path in zip(midi_objs, mid_paths)
+    )
+    assert render_timing_equal, "words_to_midi objects don't render with the timing of their midi files"
+    report = {
+        "seconds": make_seconds,
+        "dump_seconds": dump_seconds,
+        "words": int(sum(len(song) for song in fixtures["songs"])),
+        "songs_per_sec": len(midi_objs) / make_seconds,
+        "render_timing_equal": render_timing_equal,
+    }
+    try:
+        from utils import make_midi
+    except ImportError as e:
+        report["reference"] = {"skipped": f"EMOPIA utils are not available: {e}"}
+        return report
+    start = time.perf_counter()
+    reference = [make_midi(song, word2event) for song in fixtures["songs"]]
+    reference_seconds = time.perf_counter() - start
+    report["reference"] = {
+        "seconds": reference_seconds,
+        "speedup": reference_seconds / make_seconds,
+        "equal": all(midi_contents(a) == midi_contents(b) for a, b in zip(midi_objs, reference)),
+    }
+    return report
+
+
+def bench_render(args, fixtures):
+    if "midi_objs" not in fixtures:
+        return {"skipped": "needs the make_midi stage"}
+    if not os.path.exists(args.soundfont):
+        return {"skipped": f"soundfont {args.soundfont} not found"}
+    try:
+        from bot_utils.renderer import get_renderer
+        renderer = get_renderer(args.soundfont)
+    except (ImportError, OSError) as e:
+        return {"skipped": f"FluidSynth is not available: {e}"}
+    from bot_utils.encoder_pool import EncoderPool
+    from bot_utils.mastering import master
+    from bot_utils.song_metadata import write_song_metadata
+
+    mp3_dir = os.path.join(fixtures["dir"], "mp3")
+    os.makedirs(mp3_dir, exist_ok=True)
+    encoder = EncoderPool(workers=1, outputs=["mp3"])
+    synth_seconds, master_seconds, encode_seconds, audio_seconds = 0.0, 0.0, 0.0, 0.0
+    mp3_paths = []
+    for i, midi_obj in enumerate(fixtures["midi_objs"]):
+        start = time.perf_counter()
+        pcm = renderer.render(midi_obj, program=args.instrument)
+        synth_seconds += time.perf_counter() - start
+        audio_seconds += len(pcm) / renderer.sample_rate
+
+        start = time.perf_counter()
+        pcm = master(pcm, renderer.sample_rate)
+        master_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        mp3_path = os.path.join(mp3_dir, f"song{i:05d}_{args.instrument}.mp3")
+        encoder.encode(pcm, renderer.sample_rate, mp3_path)
+        write_song_metadata(mp3_path, len(pcm) / renderer.sample_rate, renderer.sample_rate, midi_obj)
+        encode_seconds += time.perf_counter() - start
+        mp3_paths.append(mp3_path)
+    fixtures["mp3_paths"] = mp3_paths
+    n_songs = len(mp3_paths)
+    seconds = synth_seconds + master_seconds + encode_seconds
+    return {
+        "seconds": seconds,
+        "synth_seconds": synth_seconds,
+        "master_seconds": master_seconds,
+        "encode_seconds": encode_seconds,
+        "audio_seconds": audio_seconds,
+        "realtime_factor": audio_seconds / seconds,
+        "songs_per_sec": n_songs / seconds,
+    }
+
+
+def bench_library(args, fixtures):
+    from bot_utils.utils import getfiles
+    from bot_utils.library_index import LibraryIndex
+    gen_dir = os.path.join(fixtures["dir"], "library")
+    os.makedirs(gen_dir, exist_ok=True)
+    programs = [0, 24, 56]
+    for i in range(args.library_size):
+        code = f"song{i:06d}"
+        open(os.path.join(gen_dir, code+".mid"), "w").close()
+        for program in programs:
+            open(os.path.join(gen_dir, f"{code}_{program}.mp3"), "w").close()
+
+    start = time.perf_counter()
+    filedict = getfiles(gen_dir)
+    getfiles_seconds = time.perf_counter() - start
+
+    index_path = os.path.join(fixtures["dir"], "library_index.json")
+    start = time.perf_counter()
+    library = LibraryIndex([gen_dir], index_path=index_path)
+    index_build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    LibraryIndex([gen_dir], index_path=index_path)
+    index_load_seconds = time.perf_counter() - start
+
+    ids = list(filedict.keys())
+    start = time.perf_counter()
+    for id in ids:
+        library.lookup(gen_dir, id)
+    lookup_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(0, args.library_size, max(args.library_size // 100, 1)):
+        library.prefix_search(gen_dir, f"song{i:06d}"[:8])
+    prefix_seconds = time.perf_counter() - start
+    return {
+        "files": args.library_size * (1 + len(programs)),
+        "getfiles_seconds": getfiles_seconds,
+        "index_build_seconds": index_build_seconds,
+        "index_load_seconds": index_load_seconds,
+        "lookup_us": lookup_seconds / len(ids) * 1e6,
+        "prefix_search_seconds": prefix_seconds,
+    }
+
+
+def bench_audio_time(args, fixtures):
+    from bot_utils.utils import get_audio_time
+    from bot_utils.song_metadata import SongMetadataStore, metadata_path
+    import bot_utils.song_metadata as song_metadata
+    mp3_paths = fixtures.get("mp3_paths")
+    if not mp3_paths:
+        mp3_dir = os.path.join(fixtures["dir"], "fixture_mp3")
+        os.makedirs(mp3_dir, exist_ok=True)
+        mp3_paths = []
+        for i in range(args.songs):
+            mp3_path = os.path.join(mp3_dir, f"song{i:05d}_{args.instrument}.mp3")
+            write_fixture_mp3(mp3_path, 120 + i)
+            mp3_paths.append(mp3_path)
+    for mp3_path in mp3_paths:
+        if os.path.exists(metadata_path(mp3_path)):
+            os.remove(metadata_path(mp3_path))
+
+    # A fresh store, so the first pass probes mp3 headers and writes sidecars.
+    song_metadata._store = SongMetadataStore()
+    start = time.perf_counter()
+    for mp3_path in mp3_paths:
+        get_audio_time(mp3_path)
+    probe_seconds = time.perf_counter() - start
+    song_metadata._store = SongMetadataStore()
+    start = time.perf_counter()
+    for mp3_path in mp3_paths:
+        get_audio_time(mp3_path)
+    sidecar_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for mp3_path in mp3_paths:
+        get_audio_time(mp3_path)
+    cached_seconds = time.perf_counter() - start
+    n = len(mp3_paths)
+    return {
+        "songs": n,
+        "probe_us": probe_seconds / n * 1e6,
+        "sidecar_us": sidecar_seconds / n * 1e6,
+        "cached_us": cached_seconds / n * 1e6,
+    }
+
+
+def bench_votes(args, fixtures):
+    from bot_utils.vote_store import VoteStore
+    rng = np.random.default_rng(args.seed)
+    store = VoteStore(os.path.join(fixtures["dir"], "votes.sqlite3"))
+    n_songs = max(args.library_size, 1)
+    users = [f"user{u}#0000" for u in range(50)]
+    start = time.perf_counter()
+    for _ in range(args.votes):
+        id = f"song{rng.integers(n_songs):06d}_24"
+        store.record_vote("bench", id, f"gen/{id}.mp3", "02:00", users[rng.integers(len(users))], int(rng.integers(1, 6)))
+    record_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(100):
+        store.top_k("bench", 9)
+    top_k_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    store.unvoted_index("bench")
+    index_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for user in users:
+        store.random_unvoted("bench", user)
+    pick_seconds = time.perf_counter() - start
+    store.close()
+    return {
+        "votes": args.votes,
+        "record_us": record_seconds / max(args.votes, 1) * 1e6,
+        "top_k_us": top_k_seconds / 100 * 1e6,
+        "unvoted_index_build_seconds": index_seconds,
+        "pick_us": pick_seconds / len(users) * 1e6,
+    }
+
+
+BENCHES = {
+    "decode": bench_decode,
+    "make_midi": bench_make_midi,
+    "render": bench_render,
+    "library": bench_library,
+    "audio_time": bench_audio_time,
+    "votes": bench_votes,
+}
+
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    dictionary = synthetic_dictionary()
+    fixtures = {
+        "dir": tempfile.mkdtemp(prefix="lofi_bench_"),
+        "dictionary": dictionary,
+        "songs": [synthetic_song(dictionary, args.bars, rng) for _ in range(args.songs)],
+    }
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": vars(args),
+        "stages": {},
+    }
+    try:
+        for name in args.stages:
+            start = time.perf_counter()
+            try:
+                result = BENCHES[name](args, fixtures)
+            except ImportError as e:
+                result = {"skipped": f"missing dependency: {e}"}
+            result["wall_seconds"] = time.perf_counter() - start
+            result["peak_rss_mb"] = peak_rss_mb()
+            report["stages"][name] = result
+            print(f"{name}: {result}", file=sys.stderr)
+    finally:
+        shutil.rmtree(fixtures["dir"], ignore_errors=True)
+
+    pipeline = [report["stages"].get(name, {}) for name in ("decode", "make_midi", "render")]
+    if all("seconds" in stage for stage in pipeline):
+        seconds = sum(stage["seconds"] for stage in pipeline)
+        report["pipeline"] = {"songs": args.songs, "seconds": seconds, "songs_per_sec": args.songs / seconds}
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the generate, render and play pipeline with a tiny random model and synthetic fixtures.")
+    parser.add_argument('-o', '--out', help='Write the JSON report to this file instead of stdout.', type=str, default=None)
+    parser.add_argument('--stages', help='Stages to run.', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('-n', '--songs', help='Number of songs to decode, convert and render.', type=int, default=8)
+    parser.add_argument('--batch-size', help='Decoding batch size.', type=int, default=4)
+    parser.add_argument('--max-tokens', help='Words decoded per song.', type=int, default=256)
+    parser.add_argument('--bars', help='Bars of each synthetic song.', type=int, default=32)
+    parser.add_argument('--d-model', help='Hidden size of the tiny model.', type=int, default=64)
+    parser.add_argument('--layers', help='Layers of the tiny model.', type=int, default=2)
+    parser.add_argument('--heads', help='Attention heads of the tiny model.', type=int, default=4)
+    parser.add_argument('--threads', help='Number of intra-op threads for CPU inference.', type=int, default=None)
+    parser.add_argument('--library-size', help='Songs in the synthetic library folder and vote store.', type=int, default=10000)
+    parser.add_argument('--votes', help='Votes recorded in the vote store.', type=int, default=20000)
+    parser.add_argument('--instrument', help='The instrument program number to render.', type=int, default=24)
+    parser.add_argument('--soundfont', help='Soundfont file path for FluidSynth to render.', type=str, default="./soundfonts/A320U.sf2")
+    parser.add_argument('--seed', help='Random seed of fixtures and sampling.', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+    report = json.dumps(run(args), indent=4)
+    if args.out is None:
+        print(report)
+    else:
+        with open(args.out, "w") as f:
+            f.write(report)
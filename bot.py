@@ -1,3 +1,8 @@
+from bot_utils.startup_profile import StartupProfile
+# Installed before any other import, so the profile sees all of them.
+startup = StartupProfile()
+startup.install()
+
 import os
 import logging
 import discord
@@ -13,6 +18,7 @@ DAY_TIME = "06:00"
 NIGHT_TIME = "18:00"
 
 logger = setting.logging.getLogger("bot")
+startup.mark("imports")
 
 
 class Bot(commands.Bot):
@@ -43,17 +49,26 @@ class Bot(commands.Bot):
     async def on_ready(self):
         logger.info(f'Logged in as {self.user} (ID: {self.user.id})')
         os.makedirs("./loop_file", exist_ok=True)
-        loop_files = glob("./loop_file/*")
+        loop_files = glob("./loop_file/**/*", recursive=True)
         for f in loop_files:
-            os.remove(f)
+            if os.path.isfile(f):
+                os.remove(f)
         logger.info("Cleaned ./loop_file")
+        # on_ready is dispatched again after a reconnect, only the first one ends the startup.
+        if not startup.marks or startup.marks[-1][0] != "gateway":
+            startup.mark("gateway")
+            startup.uninstall()
+            logger.info(startup.summary())
     
     async def setup_hook(self) -> None:
+        startup.mark("login")
         self.update_avatar.start()
         for ext in self.initial_extensions:
             await self.load_extension(ext)
+        startup.mark("extensions")
         logger.info("Syncing command to global...")
         cmds = await self.tree.sync()
+        startup.mark("command sync")
         logger.info(f"{len(cmds)} commands synced!")
 
     def switch_avatar(self, is_day: True):
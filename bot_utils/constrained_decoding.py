@@ -0,0 +1,212 @@
+import numpy as np
+import torch
+
+from bot_utils.decoding import (
+    TEMPO, CHORD, BARBEAT, TYPE, PITCH, DURATION, VELOCITY,
+    SAMPLING_PARAMS, map_state, init_words, forward_step, project, sample,
+)
+from bot_utils.metrics import get_metrics
+
+NOTE_FIELDS = {"pitch": PITCH, "duration": DURATION, "velocity": VELOCITY}
+
+
+def state_row(memory, row):
+    """Copy of one sequence of the recurrent encoder memory."""
+    return map_state(lambda m: m[row].clone(), memory)
+
+
+def set_state_row(memory, row, snapshot):
+    """Write a copy taken with `state_row` back into a row of the memory."""
+    if isinstance(memory, torch.Tensor):
+        memory[row] = snapshot
+        return
+    for m, s in zip(memory, snapshot):
+        set_state_row(m, row, s)
+
+
+class Grammar:
+    """Which compound words may follow the current state of a song.
+
+    After the opening emotion word a song is a sequence of bars. A bar starts with
+    a `Bar` metrical word, followed by `Beat_k` metrical words with increasing k,
+    each followed by notes. Notes need a beat before them, note words need a real
+    pitch, duration and velocity, and the emotion type can't appear again. A song
+    can only end once it has a note, a song at its bar budget without one has to
+    place a note before it may start another bar.
+    """
+
+    def __init__(self, dictionary, device):
+        event2word, word2event = dictionary
+        types = event2word["type"]
+        self.eos, self.emotion, self.metrical, self.note = (types[name] for name in ("EOS", "Emotion", "Metrical", "Note"))
+        self.n_type = len(types)
+        self.bar = event2word["bar-beat"]["Bar"]
+        barbeat = word2event["bar-beat"]
+        beats = [-1] * len(barbeat)
+        for i, event in barbeat.items():
+            if isinstance(event, str) and event.startswith("Beat_"):
+                beats[i] = int(event.split("_")[1])
+        self.beat_of = torch.tensor(beats, device=device)
+        self.max_beat = max(beats)
+        self.note_masks = {}
+        for key, field in NOTE_FIELDS.items():
+            events = word2event[key]
+            valid = [isinstance(events[i], str) and events[i].startswith("Note_") for i in range(len(events))]
+            self.note_masks[field] = torch.tensor(valid, device=device)
+
+    def type_mask(self, bars, last_beat, notes, min_bars, max_bars):
+        allowed = torch.zeros(len(bars), self.n_type, dtype=torch.bool, device=bars.device)
+        allowed[:, self.eos] = (bars >= min_bars) & (notes > 0)
+        allowed[:, self.metrical] = ~self.needs_note(bars, notes, max_bars) | (last_beat < 0)
+        allowed[:, self.note] = last_beat >= 0
+        return allowed
+
+    def needs_note(self, bars, notes, max_bars):
+        return (bars >= max_bars) & (notes == 0)
+
+    def barbeat_mask(self, last_beat, is_metrical, bar_allowed):
+        allowed = self.beat_of.unsqueeze(0) > last_beat.unsqueeze(1)
+        allowed[:, self.bar] = bar_allowed
+        # The field is ignored in other words, leave their sampling alone.
+        allowed[~is_metrical] = True
+        return allowed
+
+
+def decode_constrained(net, dictionary, batch_size, emotion_tag=0, max_tokens=2048, max_bars=None, min_bars=4,
+                       max_bar_tokens=256, max_resumes=4, generator=None, verbose=False, model=None):
+    """Decode `batch_size` songs with grammar masks and a bounded budget, every song finishes.
+
+    Words that are illegal in the current state get no probability, so a song
+    can't derail into an invalid sequence. A song ends after at least `min_bars`
+    bars and one note, and where it would start bar `max_bars + 1`. The encoder memory is saved at every
+    bar, a bar that runs over `max_bar_tokens` words is sampled again from its
+    start instead of restarting the song. A song that uses up `max_resumes`
+    resumes or reaches `max_tokens` words is closed after its last complete bar,
+    so a batch never takes more than `max_tokens + max_resumes * max_bar_tokens`
+    steps. `model` is only used to label metrics.
+
+    Return
+    ------
+    list
+        Compound word arrays of shape (n_words, 8) ending with EOS.
+    """
+    metrics = get_metrics()
+    device = next(net.parameters()).device
+    grammar = Grammar(dictionary, device)
+    if max_bars is None:
+        max_bars = np.iinfo(np.int64).max
+    min_bars = min(min_bars, max_bars)
+    eos_word = np.array([0, 0, 0, grammar.eos, 0, 0, 0, 0], dtype=np.int64)
+
+    init = init_words(emotion_tag)
+    results = [None] * batch_size
+    history = [[row for row in init] for _ in range(batch_size)]
+    resumes = [0] * batch_size
+    snapshots = [None] * batch_size
+    active = torch.arange(batch_size, device=device)
+    # The opening words end with the first bar.
+    bars = torch.ones(batch_size, dtype=torch.long, device=device)
+    last_beat = torch.full((batch_size,), -1, dtype=torch.long, device=device)
+    bar_tokens = torch.zeros(batch_size, dtype=torch.long, device=device)
+    notes = torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    def take_snapshot(song, row):
+        snapshots[song] = (len(history[song]), h[row].clone(), y_type[row].clone(), state_row(memory, row), bars[row].item(), notes[row].item())
+
+    def close_at_last_bar(song):
+        bar_start = snapshots[song][0] - 1
+        words = history[song]
+        # Keep the unfinished bar when the complete ones have no note.
+        if bar_start > len(init) and any(word[TYPE] == grammar.note for word in words[:bar_start]):
+            words = words[:bar_start]
+        results[song] = np.stack(words + [eos_word])
+
+    with torch.no_grad():
+        memory = None
+        words = torch.from_numpy(init).long().to(device)
+        for step in range(init.shape[0]):
+            h, y_type, memory = forward_step(net, words[step].unsqueeze(0).expand(batch_size, -1), memory)
+        for song in range(batch_size):
+            take_snapshot(song, song)
+
+        while len(active) > 0:
+            type_logits = y_type.masked_fill(~grammar.type_mask(bars, last_beat, notes, min_bars, max_bars), -float("inf"))
+            type_words = sample(type_logits, *SAMPLING_PARAMS[TYPE], generator=generator)
+            is_metrical = type_words == grammar.metrical
+            is_note = type_words == grammar.note
+            logits = project(net, h, type_words)
+            next_words = torch.zeros(len(active), 8, dtype=torch.long, device=device)
+            next_words[:, TYPE] = type_words
+            for field, field_logits in logits.items():
+                if field == BARBEAT:
+                    allowed = grammar.barbeat_mask(last_beat, is_metrical, ~grammar.needs_note(bars, notes, max_bars))
+                    field_logits = field_logits.masked_fill(~allowed, -float("inf"))
+                elif field in grammar.note_masks:
+                    allowed = grammar.note_masks[field].unsqueeze(0) | ~is_note.unsqueeze(1)
+                    field_logits = field_logits.masked_fill(~allowed, -float("inf"))
+                next_words[:, field] = sample(field_logits, *SAMPLING_PARAMS[field], generator=generator)
+            # Only the fields of the sampled type are kept, the others are set to ignore.
+            next_words[~is_metrical, TEMPO] = 0
+            next_words[~is_metrical, CHORD] = 0
+            next_words[~is_metrical, BARBEAT] = 0
+            next_words[~is_note, PITCH] = 0
+            next_words[~is_note, DURATION] = 0
+            next_words[~is_note, VELOCITY] = 0
+
+            is_bar = is_metrical & (next_words[:, BARBEAT] == grammar.bar)
+            # A song that wants to start a bar past its budget ends there instead.
+            over = is_bar & (bars >= max_bars)
+            next_words[over] = torch.from_numpy(eos_word).to(device)
+            type_words = next_words[:, TYPE]
+            is_metrical, is_bar = is_metrical & ~over, is_bar & ~over
+            is_beat = is_metrical & ~is_bar
+            bars = bars + is_bar.long()
+            notes = notes + is_note.long()
+            last_beat = torch.where(is_bar, torch.full_like(last_beat, -1), last_beat)
+            last_beat = torch.where(is_beat, grammar.beat_of[next_words[:, BARBEAT]], last_beat)
+            bar_tokens = torch.where(is_bar, torch.zeros_like(bar_tokens), bar_tokens + 1)
+
+            next_words_np = next_words.cpu().numpy()
+            finished, rollback = [], []
+            for row, song in enumerate(active.tolist()):
+                history[song].append(next_words_np[row])
+                if type_words[row].item() == grammar.eos:
+                    results[song] = np.stack(history[song])
+                    finished.append(row)
+                elif len(history[song]) >= max_tokens - 1:
+                    metrics.inc("lofi_decode_truncated_total", model=model)
+                    close_at_last_bar(song)
+                    finished.append(row)
+                elif bar_tokens[row].item() > max_bar_tokens:
+                    resumes[song] += 1
+                    metrics.inc("lofi_decode_resumes_total", model=model)
+                    if resumes[song] > max_resumes:
+                        close_at_last_bar(song)
+                        finished.append(row)
+                    else:
+                        rollback.append(song)
+            if verbose:
+                print(f"step: {len(history[active[0].item()])}, active: {len(active)}, resumed: {len(rollback)}")
+
+            if finished:
+                keep = torch.tensor([row for row in range(len(active)) if row not in set(finished)], dtype=torch.long, device=device)
+                if len(keep) == 0:
+                    break
+                active = active[keep]
+                next_words = next_words[keep]
+                bars, last_beat, bar_tokens, is_bar = bars[keep], last_beat[keep], bar_tokens[keep], is_bar[keep]
+                notes = notes[keep]
+                memory = map_state(lambda m: m.index_select(0, keep), memory)
+            h, y_type, memory = forward_step(net, next_words, memory)
+
+            for row, song in enumerate(active.tolist()):
+                if song in rollback:
+                    # Go back to the state right after the last bar word and sample the bar again.
+                    length, snap_h, snap_y_type, snap_memory, snap_bars, snap_notes = snapshots[song]
+                    del history[song][length:]
+                    h[row], y_type[row] = snap_h, snap_y_type
+                    set_state_row(memory, row, snap_memory)
+                    bars[row], last_beat[row], bar_tokens[row], notes[row] = snap_bars, -1, 0, snap_notes
+                elif is_bar[row]:
+                    take_snapshot(song, row)
+    return results
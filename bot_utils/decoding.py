@@ -0,0 +1,235 @@
+import numpy as np
+import torch
+
+from bot_utils.metrics import get_metrics
+
+# Fields of a compound word, same order as the embeddings of TransformerModel.
+TEMPO, CHORD, BARBEAT, TYPE, PITCH, DURATION, VELOCITY, EMOTION = range(8)
+
+# (temperature, top-p) of each field, same as TransformerModel.froward_output_sampling.
+SAMPLING_PARAMS = {
+    TYPE: (1.0, 0.90),
+    TEMPO: (1.2, 0.9),
+    BARBEAT: (1.2, None),
+    CHORD: (1.0, 0.99),
+    PITCH: (1.0, 0.9),
+    DURATION: (2.0, 0.9),
+    VELOCITY: (5.0, None),
+}
+
+
+def map_state(fn, memory):
+    """Apply `fn` to every tensor of the recurrent encoder memory."""
+    if memory is None:
+        return None
+    if isinstance(memory, torch.Tensor):
+        return fn(memory)
+    return type(memory)(map_state(fn, m) for m in memory)
+
+
+def init_words(emotion_tag=0):
+    """The emotion and first bar words every song starts with."""
+    return np.array([
+        [0, 0, 0, 1, 0, 0, 0, emotion_tag],  # emotion
+        [0, 0, 1, 2, 0, 0, 0, 0],  # bar
+    ])
+
+
+def embed(net, words):
+    """Embed a (batch, 8) word tensor into encoder inputs of shape (batch, d_model)."""
+    x = words.unsqueeze(1)
+    embs = torch.cat([
+        net.word_emb_tempo(x[..., TEMPO]),
+        net.word_emb_chord(x[..., CHORD]),
+        net.word_emb_barbeat(x[..., BARBEAT]),
+        net.word_emb_type(x[..., TYPE]),
+        net.word_emb_pitch(x[..., PITCH]),
+        net.word_emb_duration(x[..., DURATION]),
+        net.word_emb_velocity(x[..., VELOCITY]),
+        net.word_emb_emotion(x[..., EMOTION]),
+    ], dim=-1)
+    emb_linear = net.in_linear(embs)
+    # NOTE: Every step is a sequence of length 1, the position is always 0 like inference_from_scratch.
+    return net.pos_emb(emb_linear).squeeze(1)
+
+
+def forward_step(net, words, memory):
+    """Feed one word per sequence to the recurrent encoder, return hidden, type logits and memory."""
+    h, memory = net.transformer_encoder(embed(net, words), memory=memory)
+    return h, net.proj_type(h), memory
+
+
+def project(net, h, type_words):
+    """Logits of the other fields conditioned on the sampled type, in sampling order."""
+    tf_skip_type = net.word_emb_type(type_words)
+    y_ = net.project_concat_type(torch.cat([h, tf_skip_type], dim=-1))
+    return {
+        TEMPO: net.proj_tempo(y_),
+        BARBEAT: net.proj_barbeat(y_),
+        CHORD: net.proj_chord(y_),
+        PITCH: net.proj_pitch(y_),
+        DURATION: net.proj_duration(y_),
+        VELOCITY: net.proj_velocity(y_),
+    }
+
+
+def sample(logits, t=1.0, p=None, generator=None):
+    """Temperature and nucleus sampling of a (batch, n_class) logits tensor."""
+    probs = torch.softmax(logits.float() / t, dim=-1)
+    if p is not None:
+        sorted_probs, sorted_index = torch.sort(probs, dim=-1, descending=True)
+        # Keep the smallest prefix whose cumulative probability goes over p.
+        outside = (torch.cumsum(sorted_probs, dim=-1) - sorted_probs) > p
+        sorted_probs = sorted_probs.masked_fill(outside, 0.0)
+        probs = torch.zeros_like(probs).scatter(-1, sorted_index, sorted_probs)
+    return torch.multinomial(probs, 1, generator=generator).squeeze(-1)
+
+
+def sample_numpy(logits, t=1.0, p=None, generator=None):
+    """Sample with `models.sampling` row by row, draws from the numpy RNG like inference_from_scratch."""
+    from models import sampling
+    words = [sampling(logit, p=p, t=t) for logit in logits]
+    return torch.tensor(words, dtype=torch.long, device=logits.device)
+
+
+SAMPLERS = {
+    "torch": sample,
+    "numpy": sample_numpy,
+}
+
+
+def decode_batch(net, dictionary, batch_size, emotion_tag=0, max_tokens=None, generator=None, verbose=False, sampler="torch"):
+    """Decode `batch_size` songs together with the recurrent encoder.
+
+    Every sequence keeps its own encoder memory, a sequence that reaches EOS is
+    dropped from the batch so the rest of the steps only run on unfinished songs.
+    Each step feeds only the newest word, so its cost doesn't grow with the song.
+    `sampler` is "torch" or "numpy", the latter reproduces inference_from_scratch
+    for the same numpy seed.
+
+    Return
+    ------
+    list
+        Compound word arrays of shape (n_words, 8), None for a song that did not
+        reach EOS within `max_tokens` words.
+    """
+    event2word, word2event = dictionary
+    sample_fn = SAMPLERS[sampler]
+    device = next(net.parameters()).device
+    eos = torch.tensor([word2event['type'][i] == 'EOS' for i in range(len(word2event['type']))], device=device)
+
+    init = init_words(emotion_tag)
+    results = [None] * batch_size
+    history = [[row for row in init] for _ in range(batch_size)]
+    active = torch.arange(batch_size, device=device)
+
+    with torch.no_grad():
+        memory = None
+        words = torch.from_numpy(init).long().to(device)
+        for step in range(init.shape[0]):
+            h, y_type, memory = forward_step(net, words[step].unsqueeze(0).expand(batch_size, -1), memory)
+
+        n_words = init.shape[0]
+        while len(active) > 0 and (max_tokens is None or n_words < max_tokens):
+            type_words = sample_fn(y_type, *SAMPLING_PARAMS[TYPE], generator=generator)
+            logits = project(net, h, type_words)
+            next_words = torch.zeros(len(active), 8, dtype=torch.long, device=device)
+            next_words[:, TYPE] = type_words
+            for field, field_logits in logits.items():
+                next_words[:, field] = sample_fn(field_logits, *SAMPLING_PARAMS[field], generator=generator)
+
+            next_words_np = next_words.cpu().numpy()
+            for row, song in enumerate(active.tolist()):
+                history[song].append(next_words_np[row])
+            n_words += 1
+            if verbose:
+                print(f"step: {n_words}, active: {len(active)}")
+
+            finished = eos[type_words]
+            for song in active[finished].tolist():
+                results[song] = np.stack(history[song])
+            keep = torch.nonzero(~finished).squeeze(-1)
+            if len(keep) == 0:
+                break
+            if len(keep) < len(active):
+                active = active[keep]
+                next_words = next_words[keep]
+                memory = map_state(lambda m: m.index_select(0, keep), memory)
+            h, y_type, memory = forward_step(net, next_words, memory)
+    return results
+
+
+def decode_songs(net, dictionary, n_songs, emotion_tag=0, max_tokens=None, generator=None, verbose=False, sampler="torch", model=None):
+    """Decode `n_songs` songs in batches, decoding again the ones that failed.
+
+    `model` is only used to label the retry counter.
+    """
+    metrics = get_metrics()
+    songs = []
+    while len(songs) < n_songs:
+        results = decode_batch(net, dictionary, n_songs - len(songs), emotion_tag, max_tokens, generator, verbose, sampler)
+        finished = [res for res in results if isinstance(res, np.ndarray)]
+        metrics.inc("lofi_decode_retries_total", len(results) - len(finished), model=model)
+        songs.extend(finished)
+    return songs
+
+
+def check_parity(net, dictionary, seed=0, max_tokens=512, atol=1e-4):
+    """Check a real checkpoint with the recurrent decoder.
+
+    The words of a song decoded with a fixed seed are fed again through
+    `net.forward_hidden`, and the logits of every field are compared with the
+    ones of `forward_step` and `project`. Both run the model's recurrent encoder,
+    so this checks the batched step against the model, not against
+    `inference_from_scratch`. That one hard-codes CUDA tensors, so it is only
+    compared on CUDA, where it and the decoder with the numpy sampler must produce
+    the same song for the same seed. tests/test_decoding.py checks the parity
+    with `inference_from_scratch` on CPU with a stub model.
+
+    Return
+    ------
+    dict
+        Max absolute logits difference, number of compared words, and whether
+        the sampled songs are equal (None when CUDA is not available).
+    """
+    event2word, word2event = dictionary
+    device = next(net.parameters()).device
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    res = None
+    while not isinstance(res, np.ndarray):
+        res = decode_batch(net, dictionary, 1, max_tokens=max_tokens, sampler="numpy")[0]
+
+    n_words = len(res) - 1
+    max_diff = 0.0
+    with torch.no_grad():
+        words = torch.from_numpy(res).long().to(device)
+        ref_memory, memory = None, None
+        for step in range(len(res) - 1):
+            ref_h, ref_y_type, ref_memory = net.forward_hidden(words[step].view(1, 1, -1), ref_memory, is_training=False)
+            h, y_type, memory = forward_step(net, words[step].unsqueeze(0), memory)
+            type_words = words[step + 1, TYPE].view(1)
+            ref_logits = project(net, ref_h, type_words)
+            logits = project(net, h, type_words)
+            diffs = [(ref_y_type - y_type).abs().max().item()]
+            diffs += [(ref_logits[field] - logits[field]).abs().max().item() for field in logits]
+            max_diff = max([max_diff] + diffs)
+
+    same_song = None
+    if device.type == "cuda":
+        np.random.seed(seed)
+        ref_res = None
+        while not isinstance(ref_res, np.ndarray):
+            ref_res, _ = net.inference_from_scratch(dictionary, 0, len(event2word.keys()), display=False)
+        np.random.seed(seed)
+        res = None
+        while not isinstance(res, np.ndarray):
+            res = decode_batch(net, dictionary, 1, sampler="numpy")[0]
+        same_song = ref_res.shape == res.shape and bool((ref_res == res).all())
+
+    return {
+        "max_logits_diff": max_diff,
+        "n_words": n_words,
+        "logits_match": max_diff <= atol,
+        "same_song": same_song,
+    }
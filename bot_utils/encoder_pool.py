@@ -0,0 +1,172 @@
+import os
+import time
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from bot_utils.metrics import get_metrics
+
+logger = logging.getLogger("lofi_transformer")
+
+# ffmpeg output options of each format, a profile of the config can override any of them.
+DEFAULT_PROFILES = {
+    # LAME VBR quality 2, around 190kbps.
+    "mp3": {"suffix": ".mp3", "format": "mp3", "codec": "libmp3lame", "options": ["-q:a", "2"]},
+    # Same bitrate as the opus cache, Discord plays it without transcoding.
+    "opus": {"suffix": ".ogg", "format": "ogg", "codec": "libopus", "options": ["-b:a", "96k", "-ar", "48000"]},
+    "flac": {"suffix": ".flac", "format": "flac", "codec": "flac", "options": []},
+}
+
+
+class EncoderQueueFull(Exception):
+    """Raised when the encoder pool already holds `max_queue` jobs and the caller doesn't wait."""
+
+
+def encoder_profiles(config):
+    """The default profiles updated with the `profiles` of the `encoder` config section."""
+    profiles = {name: dict(profile) for name, profile in DEFAULT_PROFILES.items()}
+    for name, profile in config.get("encoder", {}).get("profiles", {}).items():
+        profiles[name] = dict(profiles.get(name, {}), **profile)
+    return profiles
+
+
+def with_mp3(outputs):
+    """Outputs with mp3 first, the library and votes refer to songs by their mp3 file."""
+    return ["mp3"] + [name for name in outputs if name != "mp3"]
+
+
+def output_paths(base_path, profiles, outputs):
+    """Output file of each profile, `base_path` with the suffix of the profile."""
+    base = os.path.splitext(base_path)[0]
+    return {name: base + profiles[name]["suffix"] for name in outputs}
+
+
+def encode_pcm(pcm, sample_rate, paths, profiles):
+    """Encode int16 (n_frames, channels) PCM into every output with a single ffmpeg run.
+
+    The PCM is piped to ffmpeg's stdin without a wav file, each output is
+    written next to its final path and renamed once ffmpeg succeeded. The
+    outputs get the same mtime, so none of them looks older than the others.
+    """
+    pcm = np.ascontiguousarray(pcm, dtype=np.int16)
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "s16le", "-ar", str(sample_rate), "-ac", str(pcm.shape[1]), "-i", "pipe:0",
+    ]
+    temp_paths = {}
+    for name, path in paths.items():
+        profile = profiles[name]
+        temp_paths[name] = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        command += ["-c:a", profile["codec"], *profile["options"], "-f", profile["format"], temp_paths[name]]
+    try:
+        process = subprocess.run(command, input=memoryview(pcm).cast("B"), stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed with code {process.returncode}: {process.stderr.decode(errors='replace').strip()}")
+        now = time.time_ns()
+        for name, path in paths.items():
+            os.utime(temp_paths[name], ns=(now, now))
+            os.replace(temp_paths[name], path)
+    finally:
+        for temp_path in temp_paths.values():
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return paths
+
+
+class EncoderPool:
+    """Encode PCM into the configured output formats in background threads.
+
+    A job runs one ffmpeg process for all its outputs, ffmpeg does the work
+    outside the GIL so the threads encode in parallel while the caller renders
+    the next song. At most `max_queue` jobs are pending or running, `submit`
+    waits for room or raises `EncoderQueueFull` with `block=False`.
+    """
+
+    def __init__(self, workers=2, max_queue=8, outputs=("mp3",), profiles=None):
+        self.outputs = list(outputs)
+        self.profiles = profiles or encoder_profiles({})
+        self.max_queue = int(max_queue)
+        self._room = threading.BoundedSemaphore(self.max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=int(workers), thread_name_prefix="encoder")
+
+    @classmethod
+    def from_config(cls, config):
+        encoder_config = config.get("encoder", {})
+        return cls(
+            workers=encoder_config.get("workers", 2),
+            max_queue=encoder_config.get("max_queue", 8),
+            outputs=encoder_config.get("outputs", ["mp3"]),
+            profiles=encoder_profiles(config),
+        )
+
+    def submit(self, pcm, sample_rate, base_path, outputs=None, block=True, model=None, done=None):
+        """Queue an encode job, return a future of its report.
+
+        The report holds the `paths` of each output, `queue_seconds` spent waiting
+        for a thread, `encode_seconds`, `audio_seconds` and the output `bytes`.
+        `done` is called with the report in the encoder thread before the future
+        resolves, e.g. to write the song metadata.
+        """
+        if not self._room.acquire(blocking=block):
+            raise EncoderQueueFull(f"Encoder queue is full ({self.max_queue} jobs).")
+        paths = output_paths(base_path, self.profiles, outputs or self.outputs)
+        queued = time.perf_counter()
+        try:
+            future = self._executor.submit(self._encode, pcm, sample_rate, paths, queued, model, done)
+        except Exception:
+            self._room.release()
+            raise
+        future.add_done_callback(lambda f: self._room.release())
+        return future
+
+    def encode(self, pcm, sample_rate, base_path, outputs=None, model=None):
+        """Encode and wait, return the report of `submit`."""
+        return self.submit(pcm, sample_rate, base_path, outputs, model=model).result()
+
+    def _encode(self, pcm, sample_rate, paths, queued, model, done):
+        metrics = get_metrics()
+        start = time.perf_counter()
+        with metrics.span("encode", model=model):
+            encode_pcm(pcm, sample_rate, paths, self.profiles)
+        end = time.perf_counter()
+        metrics.observe("lofi_encode_queue_seconds", start - queued, model=model)
+        report = {
+            "paths": paths,
+            "queue_seconds": start - queued,
+            "encode_seconds": end - start,
+            "audio_seconds": len(pcm) / sample_rate,
+            "bytes": {name: os.path.getsize(path) for name, path in paths.items()},
+        }
+        logger.debug(f"Encoded {', '.join(paths.values())} in {report['encode_seconds']:.2f}s after {report['queue_seconds']:.2f}s in queue.")
+        if done is not None:
+            done(report)
+        return report
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_config = {}
+
+
+def configure_encoder(config):
+    """Use the `encoder` section of the config for the process-wide pool, created on first use."""
+    global _pool, _config
+    with _pool_lock:
+        _config = config
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+            _pool = None
+
+
+def get_encoder_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = EncoderPool.from_config(_config)
+        return _pool
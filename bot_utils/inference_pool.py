@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from bot_utils.metrics import configure_metrics, get_metrics
+
+# NOTE: Workers don't import `assets.settings.setting`, its dictConfig truncates the log file.
+logger = logging.getLogger("lofi_transformer")
+
+
+class InferenceQueueFull(Exception):
+    """Raised when the inference pool already holds `max_queue` jobs."""
+
+
+def _init_worker(config, preload):
+    """Configure the model registry of a worker and load the models it will serve."""
+    from bot_utils.model_registry import configure_registry, set_num_threads
+    from bot_utils.mastering import configure_mastering
+    from bot_utils.encoder_pool import configure_encoder
+    configure_metrics(config, buffer=True)
+    configure_mastering(config)
+    configure_encoder(config)
+    inference_config = config.get("inference", {})
+    set_num_threads(inference_config.get("intra_op_threads"), inference_config.get("inter_op_threads"))
+    registry = configure_registry(config)
+    for model in preload:
+        try:
+            registry.warm_up(model)
+        except Exception as e:
+            # Let the job itself raise, a failing initializer breaks the whole pool.
+            logger.error(f"Failed to preload {model} in inference worker: {e}")
+
+
+def _run_job(fn, *args):
+    """Run a job in a worker, return its result with the metric events it recorded.
+
+    The events of a failed job are attached to its exception as `metric_events`.
+    """
+    try:
+        return fn(*args), get_metrics().drain()
+    except Exception as e:
+        e.metric_events = get_metrics().drain()
+        raise
+
+
+def _warm_up_job(model):
+    if model is not None:
+        from bot_utils.model_registry import get_registry
+        get_registry().warm_up(model)
+    return model
+
+
+def _generate_job(ckpt, out, instrument, model):
+    from generate import generate
+    return generate(ckpt=ckpt, out=out, instrument=instrument, display=False, model=model)
+
+
+def _generate_batch_job(ckpt, out, instrument, batch_size, model):
+    from generate import generate_batch
+    return generate_batch(ckpt=ckpt, out=out, instrument=instrument, batch_size=batch_size, display=False, model=model)
+
+
+def _generate_mid_job(ckpt, out, batch_size, model):
+    from generate import generate_mid
+    mid_file_paths = generate_mid(ckpt_path=ckpt, out_dir=out, verbose=False, model=model, batch_size=batch_size)
+    if batch_size == 1:
+        return [mid_file_paths]
+    return mid_file_paths
+
+
+def _render_job(mid_file_path, out_dir, instrument, mp3_file_path, model):
+    from generate import render_midi_to_mp3
+    return render_midi_to_mp3(
+        mid_file_path=mid_file_path,
+        out_dir=out_dir,
+        instrument=instrument,
+        mp3_file_path=mp3_file_path,
+        model=model,
+    )
+
+
+def _render_programs_job(mid_file_path, programs, model):
+    from generate import render_programs
+    return render_programs(mid_file_path, programs, model=model)
+
+
+class InferencePool:
+    """Run song generation and rendering in worker processes.
+
+    Each worker keeps its own model registry, so models stay loaded between jobs.
+    At most `max_queue` jobs are accepted at once, further submits raise
+    `InferenceQueueFull` instead of piling up behind a busy pool.
+    """
+
+    def __init__(self, config):
+        inference_config = config.get("inference", {})
+        self.workers = int(inference_config.get("workers", 1))
+        self.max_queue = int(inference_config.get("max_queue", 4))
+        preload = []
+        if config.get("registry", {}).get("warm_up", False):
+            preload.append(config["current_model"])
+        self.pending = 0
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            # CUDA can't be re-initialized in a forked process.
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(config, preload),
+        )
+
+    def submit(self, fn, *args):
+        """Schedule a job in the pool and return an asyncio future of its result."""
+        if self.pending >= self.max_queue:
+            raise InferenceQueueFull(f"Inference queue is full ({self.pending}/{self.max_queue}).")
+        self.pending += 1
+        get_metrics().set("lofi_inference_queue_depth", self.pending)
+        future = asyncio.get_running_loop().run_in_executor(self._executor, _run_job, fn, *args)
+        future.add_done_callback(self._job_done)
+        return asyncio.ensure_future(self._result(future))
+
+    def _job_done(self, future):
+        self.pending -= 1
+        get_metrics().set("lofi_inference_queue_depth", self.pending)
+
+    async def _result(self, future):
+        try:
+            result, events = await future
+        except Exception as e:
+            get_metrics().replay(getattr(e, "metric_events", []))
+            raise
+        get_metrics().replay(events)
+        return result
+
+    async def start(self):
+        """Spawn the workers, which preload models in their initializer."""
+        await asyncio.gather(*[self.submit(_warm_up_job, None) for _ in range(min(self.workers, self.max_queue))],
+                             return_exceptions=True)
+
+    async def warm_up(self, model):
+        """Best effort to load a model before it is used, lands on whichever worker is idle."""
+        await self.submit(_warm_up_job, model)
+
+    async def generate(self, ckpt, out, instrument, model=None):
+        """Generate a song in the pool, return its mid and mp3 path."""
+        return await self.submit(_generate_job, ckpt, out, int(instrument), model)
+
+    async def generate_batch(self, ckpt, out, instrument, batch_size, model=None):
+        """Generate `batch_size` songs in one batch, return a list of their mid and mp3 path.
+
+        The batch takes a single slot of the queue.
+        """
+        return await self.submit(_generate_batch_job, ckpt, out, int(instrument), int(batch_size), model)
+
+    async def generate_mid(self, ckpt, out, batch_size=1, model=None):
+        """Generate midi files only, for playback that renders them itself. Return a list of mid paths."""
+        return await self.submit(_generate_mid_job, ckpt, out, int(batch_size), model)
+
+    async def render(self, mid_file_path, out_dir, instrument, mp3_file_path, model=None):
+        """Render a midi file to mp3 in the pool, return the mp3 path."""
+        return await self.submit(_render_job, mid_file_path, out_dir, int(instrument), mp3_file_path, model)
+
+    async def render_programs(self, mid_file_path, programs, model=None):
+        """Render a midi file with several programs in parallel, return program to mp3 path dict."""
+        return await self.submit(_render_programs_job, mid_file_path, [int(p) for p in programs], model)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger("lofi_transformer")
+
+
+def scan_dir(gen_dir):
+    """List playable songs of a folder in one pass, return {song id: [mid path, mp3 path]}."""
+    filenames = os.listdir(gen_dir)
+    codes = {filename.split(".")[0] for filename in filenames if filename.endswith(".mid")}
+    songs = {}
+    for filename in filenames:
+        if not filename.endswith(".mp3"):
+            continue
+        song_id = filename.split(".")[0]
+        code = song_id.split("_")[0]
+        if code in codes:
+            songs[song_id] = [os.path.join(gen_dir, code+".mid"), os.path.join(gen_dir, filename)]
+    return songs
+
+
+class LibraryIndex:
+    """Persistent index of the songs in every gen_dir.
+
+    The bot adds songs as it writes them, so lookups never list a folder. The
+    index is saved with the mtime of each folder, at startup a folder is only
+    scanned again when its mtime changed since then.
+    """
+
+    def __init__(self, gen_dirs, index_path="./library_index.json", save_interval=30):
+        self.index_path = index_path
+        self.save_interval = save_interval
+        self._dirs = {}
+        self._sorted_ids = {}
+        self._mtimes = {}
+        self._last_save = 0
+        self._dirty = False
+        self._lock = threading.RLock()
+        self.load([os.path.normpath(d) for d in gen_dirs])
+
+    @classmethod
+    def from_config(cls, config):
+        library_config = config.get("library", {})
+        gen_dirs = [setting["gen_dir"] for setting in config["model_selection"].values()]
+        return cls(
+            gen_dirs,
+            index_path=library_config.get("index_path", "./library_index.json"),
+            save_interval=library_config.get("save_interval", 30),
+        )
+
+    def load(self, gen_dirs):
+        """Load the saved index and reconcile each folder by its mtime."""
+        saved = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as f:
+                    saved = json.load(f)
+            except ValueError:
+                logger.warning(f"{self.index_path} is broken, rebuild library index.")
+        with self._lock:
+            for gen_dir in gen_dirs:
+                os.makedirs(gen_dir, exist_ok=True)
+                mtime = os.stat(gen_dir).st_mtime_ns
+                entry = saved.get(gen_dir)
+                if entry is not None and entry["mtime_ns"] == mtime:
+                    songs = entry["songs"]
+                else:
+                    logger.info(f"Scanning {gen_dir} for library index.")
+                    songs = scan_dir(gen_dir)
+                    self._dirty = True
+                self._dirs[gen_dir] = songs
+                self._sorted_ids[gen_dir] = sorted(songs.keys())
+                self._mtimes[gen_dir] = mtime
+        self.flush()
+
+    def songs(self, gen_dir):
+        """The live {song id: [mid path, mp3 path]} dict of a folder."""
+        gen_dir = os.path.normpath(gen_dir)
+        with self._lock:
+            if gen_dir not in self._dirs:
+                self.load([gen_dir])
+            return self._dirs[gen_dir]
+
+    def snapshot(self, gen_dir):
+        """A copy of the songs of a folder, safe to iterate outside the event loop."""
+        songs = self.songs(gen_dir)
+        with self._lock:
+            return dict(songs)
+
+    def lookup(self, gen_dir, song_id):
+        return self.songs(gen_dir).get(song_id)
+
+    def prefix_search(self, gen_dir, prefix, limit=25):
+        """Song ids of a folder starting with `prefix`, in sorted order."""
+        gen_dir = os.path.normpath(gen_dir)
+        self.songs(gen_dir)
+        with self._lock:
+            ids = self._sorted_ids[gen_dir]
+            start = bisect.bisect_left(ids, prefix)
+            result = []
+            for song_id in ids[start:]:
+                if not song_id.startswith(prefix) or len(result) >= limit:
+                    break
+                result.append(song_id)
+            return result
+
+    def add(self, mid_path, mp3_path):
+        """Record a song the bot has just written."""
+        gen_dir = os.path.normpath(os.path.dirname(mp3_path))
+        song_id = os.path.basename(mp3_path).split(".")[0]
+        songs = self.songs(gen_dir)
+        with self._lock:
+            if song_id not in songs:
+                bisect.insort(self._sorted_ids[gen_dir], song_id)
+            songs[song_id] = [mid_path, mp3_path]
+            self._touch(gen_dir)
+
+    def remove(self, mp3_path):
+        """Forget a song whose mp3 was deleted by the bot."""
+        gen_dir = os.path.normpath(os.path.dirname(mp3_path))
+        song_id = os.path.basename(mp3_path).split(".")[0]
+        songs = self.songs(gen_dir)
+        with self._lock:
+            if songs.pop(song_id, None) is not None:
+                ids = self._sorted_ids[gen_dir]
+                i = bisect.bisect_left(ids, song_id)
+                if i < len(ids) and ids[i] == song_id:
+                    del ids[i]
+            self._touch(gen_dir)
+
+    def _touch(self, gen_dir):
+        self._mtimes[gen_dir] = os.stat(gen_dir).st_mtime_ns
+        self._dirty = True
+        if time.monotonic() - self._last_save > self.save_interval:
+            self.flush()
+
+    def flush(self):
+        """Save the index if it changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {gen_dir: {"mtime_ns": self._mtimes[gen_dir], "songs": songs} for gen_dir, songs in self._dirs.items()}
+            temp_path = self.index_path + ".part"
+            with open(temp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.index_path)
+            self._dirty = False
+            self._last_save = time.monotonic()
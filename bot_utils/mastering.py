@@ -0,0 +1,259 @@
+import numpy as np
+
+# Defaults of the `mastering` section of the config.
+DEFAULT_SETTINGS = {
+    "target_lufs": -14.0,
+    # Gain applied before the first loudness measurement of a stream, same as the old fixed boost.
+    "initial_gain_db": 20.0,
+    "max_gain_db": 30.0,
+    # Fastest change of the stream gain, in dB per second.
+    "gain_slew_db": 6.0,
+    "ceiling_db": -1.0,
+    "knee_db": 6.0,
+    "lofi": {
+        "enabled": False,
+        "lowpass_hz": 5000,
+        "noise_db": -54.0,
+        "crackles_per_second": 2.0,
+        "bits": 12,
+        "downsample": 2,
+    },
+}
+
+# BS.1770 gating: 400ms blocks with 75% overlap, -70 LUFS absolute and -10 LU relative gates.
+BLOCK_SECONDS = 0.4
+STEP_SECONDS = 0.1
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+FULL_SCALE = 32768.0
+# The stream keeps a histogram of block loudness above the absolute gate instead of every block.
+HISTOGRAM_STEP = 0.1
+HISTOGRAM_BINS = 800
+
+
+def biquad_high_shelf(sample_rate, fc=1500.0, gain_db=4.0, q=1 / np.sqrt(2)):
+    a_gain = 10 ** (gain_db / 40)
+    w0 = 2 * np.pi * fc / sample_rate
+    alpha = np.sin(w0) / (2 * q)
+    cos_w0 = np.cos(w0)
+    b = [
+        a_gain * ((a_gain + 1) + (a_gain - 1) * cos_w0 + 2 * np.sqrt(a_gain) * alpha),
+        -2 * a_gain * ((a_gain - 1) + (a_gain + 1) * cos_w0),
+        a_gain * ((a_gain + 1) + (a_gain - 1) * cos_w0 - 2 * np.sqrt(a_gain) * alpha),
+    ]
+    a = [
+        (a_gain + 1) - (a_gain - 1) * cos_w0 + 2 * np.sqrt(a_gain) * alpha,
+        2 * ((a_gain - 1) - (a_gain + 1) * cos_w0),
+        (a_gain + 1) - (a_gain - 1) * cos_w0 - 2 * np.sqrt(a_gain) * alpha,
+    ]
+    return np.array(b) / a[0], np.array(a) / a[0]
+
+
+def biquad_high_pass(sample_rate, fc=38.0, q=0.5):
+    w0 = 2 * np.pi * fc / sample_rate
+    alpha = np.sin(w0) / (2 * q)
+    cos_w0 = np.cos(w0)
+    b = [(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2]
+    a = [1 + alpha, -2 * cos_w0, 1 - alpha]
+    return np.array(b) / a[0], np.array(a) / a[0]
+
+
+class Filter:
+    """IIR filter over (n_frames, channels) chunks, keeps its state between chunks."""
+
+    def __init__(self, b, a, channels=2):
+        self.b, self.a = b, a
+        self.zi = np.zeros((max(len(a), len(b)) - 1, channels))
+
+    def __call__(self, x):
+        # scipy is imported on first use, it would add a second to the bot startup.
+        from scipy.signal import lfilter
+        y, self.zi = lfilter(self.b, self.a, x, axis=0, zi=self.zi)
+        return y
+
+
+class KWeighting:
+    """BS.1770 K-weighting, a high shelf then a high pass."""
+
+    def __init__(self, sample_rate, channels=2):
+        self.shelf = Filter(*biquad_high_shelf(sample_rate), channels)
+        self.high_pass = Filter(*biquad_high_pass(sample_rate), channels)
+
+    def __call__(self, x):
+        return self.high_pass(self.shelf(x))
+
+
+def block_loudness(energy):
+    """LUFS of mean square energies summed over the channels."""
+    return -0.691 + 10 * np.log10(np.maximum(energy, 1e-12))
+
+
+def gated_loudness(blocks):
+    """Integrated loudness of (n_blocks,) block energies, None when every block is gated."""
+    blocks = blocks[block_loudness(blocks) > ABSOLUTE_GATE]
+    if len(blocks) == 0:
+        return None
+    relative = block_loudness(blocks.mean()) + RELATIVE_GATE
+    blocks = blocks[block_loudness(blocks) > relative]
+    return float(block_loudness(blocks.mean()))
+
+
+def integrated_loudness(x, sample_rate):
+    """Integrated loudness in LUFS of a (n_frames, channels) float array in full scale units."""
+    weighted = KWeighting(sample_rate, x.shape[1])(x / FULL_SCALE)
+    power = np.concatenate([np.zeros(1), np.cumsum(np.square(weighted).sum(axis=1))])
+    block, step = int(BLOCK_SECONDS * sample_rate), int(STEP_SECONDS * sample_rate)
+    starts = np.arange(0, len(weighted) - block + 1, step)
+    if len(starts) == 0:
+        return None
+    return gated_loudness((power[starts + block] - power[starts]) / block)
+
+
+def target_gain_db(loudness, settings):
+    """Gain in dB that brings `loudness` to the target, capped at `max_gain_db`."""
+    return min(settings["target_lufs"] - loudness, settings["max_gain_db"])
+
+
+def soft_limit(x, ceiling_db=-1.0, knee_db=6.0):
+    """Pass samples below the knee, bend the ones above it towards the ceiling with tanh, in place."""
+    ceiling = FULL_SCALE * 10 ** (ceiling_db / 20)
+    knee = ceiling * 10 ** (-knee_db / 20)
+    over = np.abs(x) > knee
+    loud = x[over]
+    x[over] = np.sign(loud) * (knee + (ceiling - knee) * np.tanh((np.abs(loud) - knee) / (ceiling - knee)))
+    return x
+
+
+class LofiColor:
+    """Low pass, bitcrush and vinyl noise, all keep their state between chunks."""
+
+    def __init__(self, sample_rate, settings, channels=2, seed=None):
+        from scipy.signal import butter
+        self.low_pass = Filter(*butter(2, settings["lowpass_hz"], fs=sample_rate), channels)
+        self.step = 2.0 ** (1 - int(settings["bits"]))
+        self.downsample = max(int(settings["downsample"]), 1)
+        self.noise = FULL_SCALE * 10 ** (settings["noise_db"] / 20)
+        self.crackle_rate = settings["crackles_per_second"] / sample_rate
+        self.rng = np.random.default_rng(seed)
+        self._offset = 0
+        self._held = np.zeros(channels)
+
+    def __call__(self, x):
+        x = self.low_pass(x)
+        if self.downsample > 1:
+            # Sample and hold: every frame repeats the first frame of its group.
+            positions = self._offset + np.arange(len(x))
+            local = positions - positions % self.downsample - self._offset
+            held = x[np.maximum(local, 0)]
+            held[local < 0] = self._held
+            x = held
+            self._offset += len(x)
+            self._held = x[-1].copy() if len(x) else self._held
+        x = np.round(x / (FULL_SCALE * self.step)) * (FULL_SCALE * self.step)
+        noise = self.rng.standard_normal(x.shape) * self.noise
+        crackles = self.rng.random(len(x)) < self.crackle_rate
+        noise[crackles] += self.rng.uniform(-1, 1, (crackles.sum(), 1)) * self.noise * 30
+        x += noise
+        return x
+
+
+def mastering_settings(config):
+    """The `mastering` section of the config over the defaults."""
+    section = config.get("mastering", {})
+    settings = dict(DEFAULT_SETTINGS, **{k: v for k, v in section.items() if k != "lofi"})
+    settings["lofi"] = dict(DEFAULT_SETTINGS["lofi"], **section.get("lofi", {}))
+    return settings
+
+
+class Mastering:
+    """Loudness normalization, optional lofi color and a soft limiter on int16 PCM chunks.
+
+    `process` takes (n_frames, channels) int16 chunks as the synthesizer yields
+    them and returns int16 chunks of the same size. The loudness is measured on
+    everything seen so far with BS.1770 gating, and the gain moves towards the
+    target by at most `gain_slew_db` per second, ramped over each chunk. Blocks
+    are counted in a histogram of 0.1 LU bins, so the relative gate costs the
+    same on every chunk however long the stream is.
+    """
+
+    def __init__(self, sample_rate, settings=None, channels=2, seed=None):
+        self.sample_rate = sample_rate
+        self.settings = settings = settings or mastering_settings({})
+        self.color = LofiColor(sample_rate, settings["lofi"], channels, seed) if settings["lofi"]["enabled"] else None
+        self.k_weighting = KWeighting(sample_rate, channels)
+        self.gain_db = float(settings["initial_gain_db"])
+        self._step = int(STEP_SECONDS * sample_rate)
+        self._steps_per_block = round(BLOCK_SECONDS / STEP_SECONDS)
+        self._pending = np.zeros(0)
+        self._steps = []
+        self._bin_counts = np.zeros(HISTOGRAM_BINS)
+        self._bin_energies = np.zeros(HISTOGRAM_BINS)
+
+    def _measure(self, x):
+        # Mean square of every 100ms step, a block is the mean of 4 consecutive steps.
+        weighted = self.k_weighting(x / FULL_SCALE)
+        energy = np.concatenate([self._pending, np.square(weighted).sum(axis=1)])
+        n_steps = len(energy) // self._step
+        self._pending = energy[n_steps * self._step:]
+        self._steps.extend(energy[:n_steps * self._step].reshape(n_steps, self._step).mean(axis=1))
+        n = self._steps_per_block
+        blocks = []
+        while len(self._steps) >= n:
+            blocks.append(sum(self._steps[:n]) / n)
+            del self._steps[0]
+        blocks = np.array(blocks)
+        blocks = blocks[block_loudness(blocks) > ABSOLUTE_GATE]
+        bins = np.minimum(((block_loudness(blocks) - ABSOLUTE_GATE) / HISTOGRAM_STEP).astype(int), HISTOGRAM_BINS - 1)
+        np.add.at(self._bin_counts, bins, 1)
+        np.add.at(self._bin_energies, bins, blocks)
+        return self._gated_loudness()
+
+    def _gated_loudness(self):
+        """`gated_loudness` of every block so far, the relative gate rounded down to its bin."""
+        count = self._bin_counts.sum()
+        if count == 0:
+            return None
+        relative = block_loudness(self._bin_energies.sum() / count) + RELATIVE_GATE
+        first = max(int((relative - ABSOLUTE_GATE) / HISTOGRAM_STEP), 0)
+        return float(block_loudness(self._bin_energies[first:].sum() / self._bin_counts[first:].sum()))
+
+    def process(self, chunk):
+        x = chunk.astype(np.float64)
+        if self.color is not None:
+            x = self.color(x)
+        loudness = self._measure(x)
+        start_db = self.gain_db
+        if loudness is not None:
+            max_change = self.settings["gain_slew_db"] * len(x) / self.sample_rate
+            self.gain_db += float(np.clip(target_gain_db(loudness, self.settings) - start_db, -max_change, max_change))
+        gain = 10 ** (np.linspace(start_db, self.gain_db, len(x), endpoint=False) / 20)
+        x *= gain[:, None]
+        soft_limit(x, self.settings["ceiling_db"], self.settings["knee_db"])
+        return x.astype(np.int16)
+
+
+def master(pcm, sample_rate, settings=None, seed=None):
+    """Master a whole int16 track with the gain of its integrated loudness, the stream ramp is not needed."""
+    settings = settings or mastering_settings({})
+    x = pcm.astype(np.float64)
+    if settings["lofi"]["enabled"]:
+        x = LofiColor(sample_rate, settings["lofi"], x.shape[1], seed)(x)
+    loudness = integrated_loudness(x, sample_rate)
+    gain_db = settings["initial_gain_db"] if loudness is None else target_gain_db(loudness, settings)
+    x *= 10 ** (gain_db / 20)
+    soft_limit(x, settings["ceiling_db"], settings["knee_db"])
+    return x.astype(np.int16)
+
+
+_settings = mastering_settings({})
+
+
+def configure_mastering(config):
+    """Set the process-wide mastering settings from the `mastering` section of the config."""
+    global _settings
+    _settings = mastering_settings(config)
+    return _settings
+
+
+def get_mastering_settings():
+    return _settings
@@ -0,0 +1,186 @@
+import time
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger("lofi_transformer")
+
+# Upper bounds in seconds, from a token step up to a long song render.
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+COUNTER, GAUGE, HISTOGRAM = "counter", "gauge", "histogram"
+
+
+class Span:
+    """Time a block and observe it in the `lofi_stage_seconds` histogram."""
+
+    def __init__(self, metrics, stage, labels):
+        self.metrics = metrics
+        self.stage = stage
+        self.labels = labels
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self._start
+        self.metrics.observe("lofi_stage_seconds", self.seconds, stage=self.stage, **self.labels)
+        if exc_type is not None:
+            self.metrics.inc("lofi_stage_errors_total", stage=self.stage, **self.labels)
+        return False
+
+
+class NullSpan:
+    seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Every call returns right away when metrics are disabled, and `span` hands out
+    a shared no-op context manager. Inference workers run with `buffer=True`,
+    they keep their events in a list that is sent back with the job result and
+    replayed in the main process, which serves them.
+    """
+
+    def __init__(self, enabled=False, buffer=False, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buffer = buffer
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._types = {}
+        self._events = []
+        self._lock = threading.Lock()
+
+    def span(self, stage, **labels):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, stage, labels)
+
+    def inc(self, name, value=1, **labels):
+        if self.enabled:
+            self._record(COUNTER, name, value, labels)
+
+    def set(self, name, value, **labels):
+        if self.enabled:
+            self._record(GAUGE, name, value, labels)
+
+    def observe(self, name, value, **labels):
+        if self.enabled:
+            self._record(HISTOGRAM, name, value, labels)
+
+    def _record(self, kind, name, value, labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None)))
+        with self._lock:
+            if self.buffer:
+                self._events.append((kind, key, value))
+                return
+            self._types[name] = kind
+            if kind == COUNTER:
+                self._values[key] = self._values.get(key, 0) + value
+            elif kind == GAUGE:
+                self._values[key] = value
+            else:
+                histogram = self._values.get(key)
+                if histogram is None:
+                    histogram = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+                for i, bound in enumerate(self.buckets):
+                    if value <= bound:
+                        histogram[0][i] += 1
+                histogram[1] += value
+                histogram[2] += 1
+
+    def drain(self):
+        """Events buffered since the last call, in a picklable list."""
+        with self._lock:
+            events, self._events = self._events, []
+        return events
+
+    def replay(self, events):
+        """Apply events drained from another process."""
+        if not self.enabled:
+            return
+        for kind, (name, labels), value in events:
+            self._record(kind, name, value, dict(labels))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            items = sorted(self._values.items())
+            types = dict(self._types)
+        last_name = None
+        for (name, labels), value in items:
+            if name != last_name:
+                lines.append(f"# TYPE {name} {types[name]}")
+                last_name = name
+            if types[name] != HISTOGRAM:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            bucket_counts, total, count = value
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {bucket_count}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = [(k, v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in labels]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+async def serve_metrics(metrics, host="127.0.0.1", port=9108):
+    """Serve `metrics.render()` over HTTP for Prometheus to scrape, return the asyncio server."""
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Skip the headers, every path answers the metrics.
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if not request_line.startswith(b"GET"):
+                writer.write(b"HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            else:
+                body = metrics.render().encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                    + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                    + body
+                )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+_metrics = Metrics()
+
+
+def configure_metrics(config, buffer=False):
+    """Enable or disable the process-wide metrics from the `metrics` section of the config."""
+    _metrics.enabled = bool(config.get("metrics", {}).get("enabled", False))
+    _metrics.buffer = buffer
+    return _metrics
+
+
+def get_metrics():
+    return _metrics
@@ -0,0 +1,118 @@
+import threading
+
+import numpy as np
+from miditoolkit.midi.parser import MidiFile
+from miditoolkit.midi.containers import Instrument, Marker, Note, TempoChange
+
+# Same resolution as make_midi of the EMOPIA utils.
+BEAT_RESOL = 480
+BAR_RESOL = BEAT_RESOL * 4
+TICK_RESOL = BEAT_RESOL // 4
+# make_midi plays notes of duration 0 with this duration.
+DEFAULT_DURATION = 60
+
+TEMPO, CHORD, BARBEAT, TYPE, PITCH, DURATION, VELOCITY = range(7)
+
+
+def event_values(events):
+    """Integer value after the last `_` of each event, -1 for events without one like 0 or CONTI."""
+    values = np.full(len(events), -1, dtype=np.int64)
+    for i in range(len(events)):
+        event = events[i]
+        if isinstance(event, str) and event != "CONTI":
+            try:
+                values[i] = int(event.split("_")[-1])
+            except ValueError:
+                pass
+    return values
+
+
+class MidiTables:
+    """Lookup tables from word indices to the values make_midi reads from events."""
+
+    def __init__(self, word2event):
+        types = word2event["type"]
+        self.is_metrical = np.array([types[i] == "Metrical" for i in range(len(types))])
+        self.is_note = np.array([types[i] == "Note" for i in range(len(types))])
+        barbeat = word2event["bar-beat"]
+        self.is_bar = np.array([barbeat[i] == "Bar" for i in range(len(barbeat))])
+        self.beat = np.array([
+            int(barbeat[i].split("_")[1]) if isinstance(barbeat[i], str) and "Beat" in barbeat[i] else -1
+            for i in range(len(barbeat))
+        ])
+        self.tempo = event_values(word2event["tempo"])
+        chord = word2event["chord"]
+        self.chord = [None if chord[i] in ("CONTI", 0) else str(chord[i]) for i in range(len(chord))]
+        self.pitch = event_values(word2event["pitch"])
+        self.duration = event_values(word2event["duration"])
+        self.velocity = event_values(word2event["velocity"])
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def get_tables(word2event):
+    """Tables of a dictionary, built on first use."""
+    with _tables_lock:
+        tables = _tables.get(id(word2event))
+        if tables is None or tables[0] is not word2event:
+            tables = _tables[id(word2event)] = (word2event, MidiTables(word2event))
+        return tables[1]
+
+
+def words_to_tables(words, tables):
+    """Note, tempo and chord tables of a compound word array, same events as make_midi.
+
+    Return
+    ------
+    dict
+        `notes` (n, 4) array of start, end, pitch and velocity, `tempos` (n, 2)
+        array of time and tempo, `chords` list of (time, text).
+    """
+    words = np.asarray(words)
+    metrical = tables.is_metrical[words[:, TYPE]]
+    note = tables.is_note[words[:, TYPE]]
+    beat = np.where(metrical, tables.beat[words[:, BARBEAT]], -1)
+    is_beat = beat >= 0
+    bar_cnt = np.cumsum(metrical & tables.is_bar[words[:, BARBEAT]])
+
+    # Position of the last beat word at or before each word, 0 before the first one.
+    last_beat = np.maximum.accumulate(np.where(is_beat, np.arange(len(words)), -1))
+    beat_pos = bar_cnt * BAR_RESOL + beat * TICK_RESOL
+    cur_pos = np.where(last_beat >= 0, beat_pos[np.maximum(last_beat, 0)], 0)
+
+    tempo = tables.tempo[words[:, TEMPO]]
+    tempo_rows = np.flatnonzero(is_beat & (tempo >= 0))
+    chord_rows = np.flatnonzero(is_beat)
+
+    pitch = tables.pitch[words[:, PITCH]]
+    duration = tables.duration[words[:, DURATION]]
+    velocity = tables.velocity[words[:, VELOCITY]]
+    # make_midi skips notes with a field it can't parse.
+    note_rows = np.flatnonzero(note & (pitch >= 0) & (duration >= 0) & (velocity >= 0))
+    start = cur_pos[note_rows]
+    end = start + np.where(duration[note_rows] == 0, DEFAULT_DURATION, duration[note_rows])
+    return {
+        "notes": np.stack([start, end, pitch[note_rows], velocity[note_rows]], axis=1),
+        "tempos": np.stack([cur_pos[tempo_rows], tempo[tempo_rows]], axis=1),
+        "chords": [(time, tables.chord[c]) for time, c in zip(cur_pos[chord_rows].tolist(), words[chord_rows, CHORD].tolist()) if tables.chord[c] is not None],
+    }
+
+
+def words_to_midi(words, word2event):
+    """Vectorized make_midi, build the same midi object from a compound word array."""
+    song = words_to_tables(words, get_tables(word2event))
+    midi_obj = MidiFile()
+    midi_obj.tempo_changes = [TempoChange(tempo=tempo, time=time) for time, tempo in song["tempos"].tolist()]
+    midi_obj.markers = [Marker(text=text, time=time) for time, text in song["chords"]]
+    piano_track = Instrument(0, is_drum=False, name='piano')
+    piano_track.notes = [
+        Note(pitch=pitch, start=start, end=end, velocity=velocity)
+        for start, end, pitch, velocity in song["notes"].tolist()
+    ]
+    midi_obj.instruments = [piano_track]
+    # Set as parsing the dumped file would, the tick to time mapping only goes up to max_tick.
+    ticks = [song["notes"][:, 1].max(initial=0), song["tempos"][:, 0].max(initial=0)] + [time for time, _ in song["chords"]]
+    midi_obj.max_tick = int(max(ticks)) + 1
+    return midi_obj
@@ -0,0 +1,235 @@
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import torch
+
+from models import TransformerModel
+from bot_utils.metrics import get_metrics
+
+DATASET_PATH = "./lofi_dataset"
+# Suffix of checkpoints written by convert_ckpt.py.
+MAPPED_SUFFIX = ".mmap.pt"
+
+
+def load_dictionary(dataset_path=DATASET_PATH):
+    """Load (event2word, word2event) dictionary of the compound word vocabulary."""
+    with open(os.path.join(dataset_path, "dictionary.pkl"), 'rb') as f:
+        return pickle.load(f)
+
+
+def load_state_dict(ckpt_path, device="cpu"):
+    """Load checkpoint once and strip the `module.` prefix left by DataParallel."""
+    state_dict = torch.load(ckpt_path, map_location=device)
+    return normalize_keys(state_dict)
+
+
+def normalize_keys(state_dict):
+    if all(k.startswith("module.") for k in state_dict.keys()):
+        state_dict = OrderedDict((k[7:], v) for k, v in state_dict.items())
+    return state_dict
+
+
+def mapped_path(ckpt_path):
+    """Converted checkpoint of `ckpt_path`, see convert_ckpt.py."""
+    return os.path.splitext(ckpt_path)[0] + MAPPED_SUFFIX
+
+
+def has_mapped(ckpt_path):
+    """Whether the converted checkpoint exists and is not older than the original."""
+    path = mapped_path(ckpt_path)
+    if not os.path.exists(path):
+        return False
+    return not os.path.exists(ckpt_path) or os.path.getmtime(path) >= os.path.getmtime(ckpt_path)
+
+
+def load_mapped_state_dict(ckpt_path):
+    """Map the tensors of a converted checkpoint from the page cache without reading them.
+
+    The pages are shared by every process that maps the same file, and only
+    read from disk when first used. Fall back to a regular load on torch
+    versions without `mmap`.
+    """
+    path = mapped_path(ckpt_path)
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except TypeError:
+        return torch.load(path, map_location="cpu")
+
+
+def model_nbytes(net):
+    """Memory used by the state of a model, including packed weights of quantized layers."""
+    def nbytes(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(nbytes(v) for v in value)
+        return 0
+    return sum(nbytes(v) for v in net.state_dict().values())
+
+
+def resolve_device(device):
+    """Fall back to CPU when CUDA is requested but not available."""
+    if device is None:
+        device = "cuda"
+    if str(device).startswith("cuda") and not torch.cuda.is_available():
+        return "cpu"
+    return device
+
+
+def set_num_threads(intra_op_threads=None, inter_op_threads=None):
+    """Set torch thread pools, call it before the first inference of a worker."""
+    if intra_op_threads:
+        torch.set_num_threads(int(intra_op_threads))
+    if inter_op_threads:
+        torch.set_num_interop_threads(int(inter_op_threads))
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models and the event/word dictionary.
+
+    Models are keyed by their name in `model_selection` of `config.json`. Loaded
+    models stay resident and are evicted in least recently used order once the
+    total size goes over `memory_budget_mb`. A budget of `None` never evicts.
+
+    Each entry may set `device` ("cuda" by default, "cpu" when CUDA is not
+    available) and `quantize` to apply dynamic int8 quantization to the linear
+    layers, which only runs on CPU.
+    """
+
+    def __init__(self, model_selection=None, dataset_path=DATASET_PATH, memory_budget_mb=None):
+        self.model_selection = dict(model_selection or {})
+        self.dataset_path = dataset_path
+        self.memory_budget = None if memory_budget_mb is None else int(memory_budget_mb * 1024 * 1024)
+        self._dictionary = None
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+    @property
+    def dictionary(self):
+        with self._lock:
+            if self._dictionary is None:
+                with get_metrics().span("dictionary_load"):
+                    self._dictionary = load_dictionary(self.dataset_path)
+            return self._dictionary
+
+    @property
+    def n_class(self):
+        """Number of classes for each token."""
+        event2word, _ = self.dictionary
+        return [len(event2word[key]) for key in event2word.keys()]
+
+    def register(self, name, ckpt_path, **setting):
+        """Add a model entry that is not in `model_selection`."""
+        with self._lock:
+            self.model_selection.setdefault(name, {}).update(ckpt_path=ckpt_path, **setting)
+
+    def setting(self, name):
+        """The `model_selection` entry of a model."""
+        return self.model_selection.get(name, {})
+
+    def device(self, name):
+        if self.setting(name).get("quantize", False):
+            return "cpu"
+        return resolve_device(self.setting(name).get("device"))
+
+    def name_for_ckpt(self, ckpt_path):
+        """Find the model name of a checkpoint path, register it if unknown."""
+        with self._lock:
+            for name, setting in self.model_selection.items():
+                if setting.get("ckpt_path") == ckpt_path:
+                    return name
+            self.register(ckpt_path, ckpt_path)
+            return ckpt_path
+
+    def get(self, name):
+        """Return the loaded model, load it if it is not resident yet."""
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name]
+            net = self._load(name)
+            self._models[name] = net
+            self._sizes[name] = model_nbytes(net)
+            self._evict(keep=name)
+            return net
+
+    def get_by_ckpt(self, ckpt_path):
+        return self.get(self.name_for_ckpt(ckpt_path))
+
+    def warm_up(self, name):
+        """Load model and dictionary ahead of the first generation."""
+        self.get(name)
+
+    def evict(self, name):
+        with self._lock:
+            self._models.pop(name, None)
+            self._sizes.pop(name, None)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def loaded(self):
+        """Names of resident models, least recently used first."""
+        with self._lock:
+            return list(self._models.keys())
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def _load(self, name):
+        if name not in self.model_selection:
+            raise KeyError(f"Model {name} is not in model selection.")
+        setting = self.model_selection[name]
+        device = self.device(name)
+        n_class = self.n_class
+        with get_metrics().span("checkpoint_load", model=name):
+            net = TransformerModel(n_class, is_training=False)
+            if has_mapped(setting["ckpt_path"]):
+                state_dict = load_mapped_state_dict(setting["ckpt_path"])
+                try:
+                    # Use the mapped tensors as parameters instead of copying them, a CPU model shares them.
+                    net.load_state_dict(state_dict, assign=True)
+                except TypeError:
+                    net.load_state_dict(state_dict)
+            else:
+                net.load_state_dict(load_state_dict(setting["ckpt_path"], device=device))
+            net.to(device)
+        net.eval()
+        if setting.get("quantize", False):
+            net = torch.quantization.quantize_dynamic(net, {torch.nn.Linear}, dtype=torch.qint8)
+        return net
+
+    def _evict(self, keep):
+        if self.memory_budget is None:
+            return
+        while self.resident_bytes() > self.memory_budget and len(self._models) > 1:
+            name = next(iter(self._models))
+            if name == keep:
+                break
+            self.evict(name)
+
+
+_registry = None
+
+
+def configure_registry(config):
+    """Create the process-wide registry from the bot config."""
+    global _registry
+    registry_config = config.get("registry", {})
+    _registry = ModelRegistry(
+        model_selection=config.get("model_selection", {}),
+        dataset_path=registry_config.get("dataset_path", DATASET_PATH),
+        memory_budget_mb=registry_config.get("memory_budget_mb"),
+    )
+    return _registry
+
+
+def get_registry():
+    """Return the process-wide registry, create an empty one if not configured."""
+    global _registry
+    if _registry is None:
+        _registry = ModelRegistry()
+    return _registry
@@ -0,0 +1,106 @@
+import os
+import hashlib
+import logging
+import subprocess
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("lofi_transformer")
+
+
+class OpusCache:
+    """Ogg/Opus copies of rendered songs that Discord can play without transcoding.
+
+    Songs are transcoded once with ffmpeg at the voice bitrate and played with
+    `discord.FFmpegOpusAudio(codec="copy")`, so neither ffmpeg nor discord.py
+    re-encode them on every play. The least recently played files are evicted
+    once the cache gets over `max_mb`.
+    """
+
+    def __init__(self, cache_dir="./opus_cache", max_mb=1024, bitrate=96):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.bitrate = int(bitrate)
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._restore()
+
+    @classmethod
+    def from_config(cls, config):
+        cache_config = config.get("opus_cache", {})
+        return cls(
+            cache_dir=cache_config.get("dir", "./opus_cache"),
+            max_mb=cache_config.get("max_mb", 1024),
+            bitrate=cache_config.get("bitrate", 96),
+        )
+
+    def _restore(self):
+        """Index cached files, oldest played first."""
+        paths = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith(".ogg")]
+        for path in sorted(paths, key=os.path.getmtime):
+            size = os.path.getsize(path)
+            self._entries[path] = size
+            self.bytes += size
+
+    def cache_path(self, audio_path):
+        """Cache file of an audio file, hashed on its absolute path since ids repeat across gen dirs."""
+        digest = hashlib.sha1(os.path.abspath(audio_path).encode()).hexdigest()[:12]
+        name = os.path.basename(audio_path).split(".")[0]
+        return os.path.join(self.cache_dir, f"{name}_{digest}.ogg")
+
+    def get(self, audio_path):
+        """Return the cached opus file of an audio file, or None if it is missing or stale.
+
+        An up to date `.ogg` written next to the audio by the encoder pool is used
+        as is, it is not counted in the cache size.
+        """
+        sibling = os.path.splitext(audio_path)[0] + ".ogg"
+        if sibling != audio_path and os.path.exists(sibling):
+            if not os.path.exists(audio_path) or os.path.getmtime(sibling) >= os.path.getmtime(audio_path):
+                return sibling
+        path = self.cache_path(audio_path)
+        with self._lock:
+            if path not in self._entries:
+                return None
+            if os.path.exists(audio_path) and os.path.getmtime(audio_path) > os.path.getmtime(path):
+                return None
+            self._entries.move_to_end(path)
+        os.utime(path)
+        return path
+
+    def ensure(self, audio_path):
+        """Transcode an audio file into the cache if needed, return the opus file path."""
+        path = self.get(audio_path)
+        if path is not None:
+            return path
+        path = self.cache_path(audio_path)
+        temp_path = f"{path}.{threading.get_ident()}.part"
+        subprocess.run(
+            ["ffmpeg", "-y", "-loglevel", "error", "-i", audio_path,
+             "-c:a", "libopus", "-b:a", f"{self.bitrate}k", "-ar", "48000", "-ac", "2",
+             "-f", "ogg", temp_path],
+            check=True,
+        )
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self.bytes += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+        self._evict(keep=path)
+        logger.debug(f"Cached {audio_path} as {path}.")
+        return path
+
+    def _evict(self, keep):
+        with self._lock:
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                path, size = next(iter(self._entries.items()))
+                if path == keep:
+                    break
+                del self._entries[path]
+                self.bytes -= size
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,156 @@
+import threading
+
+import numpy as np
+
+DEFAULT_SOUNDFONT = "./soundfonts/A320U.sf2"
+# Same defaults as the fluidsynth command line used by midi2audio.
+SAMPLE_RATE = 44100
+GAIN = 0.2
+DRUM_CHANNEL = 9
+
+NOTE_OFF, CONTROL_CHANGE, NOTE_ON = range(3)
+# Tempo miditoolkit writes at tick 0 when a song has none there.
+DEFAULT_BPM = 120
+
+
+def tick_to_time_mapping(midi_obj):
+    """Seconds of every tick, as for the midi file the object dumps to.
+
+    Objects built in memory keep `max_tick` at 0 and have no tempo at tick 0,
+    the mapping covers every event and plays the ticks before the first tempo
+    change at the default tempo like the dumped file does.
+    """
+    max_tick = max([midi_obj.max_tick] + [
+        max([note.end for note in instrument.notes] + [cc.time for cc in instrument.control_changes], default=0)
+        for instrument in midi_obj.instruments
+    ] + [tempo.time for tempo in midi_obj.tempo_changes] + [marker.time for marker in midi_obj.markers])
+    tempos = sorted((tempo.time, tempo.tempo) for tempo in midi_obj.tempo_changes)
+    if not tempos or tempos[0][0] > 0:
+        tempos.insert(0, (0, DEFAULT_BPM))
+    starts = np.array([time for time, _ in tempos])
+    tick_seconds = 60.0 / (np.array([tempo for _, tempo in tempos], dtype=np.float64) * midi_obj.ticks_per_beat)
+    start_seconds = np.concatenate([[0.0], np.cumsum(np.diff(starts) * tick_seconds[:-1])])
+    ticks = np.arange(max_tick + 1)
+    segment = np.searchsorted(starts, ticks, side="right") - 1
+    return start_seconds[segment] + (ticks - starts[segment]) * tick_seconds[segment]
+
+
+def midi_events(midi_obj, program=None):
+    """Flatten the instruments of a midi object into (seconds, kind, channel, a, b) events.
+
+    `program` overrides the program of every non-drum instrument without touching
+    the midi object. Events at the same time are ordered note off, control change,
+    note on, so a repeated note is released before it is struck again.
+    """
+    tick_to_time = tick_to_time_mapping(midi_obj)
+    max_tick = len(tick_to_time) - 1
+    programs = {}
+    events = []
+    channel = 0
+    for instrument in midi_obj.instruments:
+        if instrument.is_drum:
+            inst_channel = DRUM_CHANNEL
+        else:
+            if channel == DRUM_CHANNEL:
+                channel += 1
+            inst_channel = channel % 16
+            channel += 1
+            programs[inst_channel] = instrument.program if program is None else int(program)
+        for note in instrument.notes:
+            events.append((tick_to_time[min(note.start, max_tick)], NOTE_ON, inst_channel, note.pitch, note.velocity))
+            events.append((tick_to_time[min(note.end, max_tick)], NOTE_OFF, inst_channel, note.pitch, 0))
+        for cc in instrument.control_changes:
+            events.append((tick_to_time[min(cc.time, max_tick)], CONTROL_CHANGE, inst_channel, cc.number, cc.value))
+    events.sort(key=lambda e: (e[0], e[1]))
+    return programs, events
+
+
+class MidiRenderer:
+    """FluidSynth synthesizer that keeps its soundfont loaded between renders.
+
+    MIDI events are sent to the synthesizer directly and the samples are read
+    back as int16 stereo numpy arrays, no wav file is written. A renderer is not
+    thread-safe, use `get_renderer` to get one per thread.
+    """
+
+    def __init__(self, soundfont=DEFAULT_SOUNDFONT, sample_rate=SAMPLE_RATE, gain=GAIN):
+        import fluidsynth
+        self.soundfont = soundfont
+        self.sample_rate = sample_rate
+        self.synth = fluidsynth.Synth(gain=gain, samplerate=float(sample_rate))
+        self.sfid = self.synth.sfload(soundfont)
+        if self.sfid == -1:
+            raise FileNotFoundError(f"Failed to load soundfont {soundfont}.")
+
+    def _read(self, n_frames):
+        return np.asarray(self.synth.get_samples(n_frames), dtype=np.int16).reshape(-1, 2)
+
+    def render(self, midi_obj, program=None, tail=1.0):
+        """Render a midi object to a (n_frames, 2) int16 array, see `stream` for parameters."""
+        return np.concatenate(list(self.stream(midi_obj, program, tail)))
+
+    def stream(self, midi_obj, program=None, tail=1.0, chunk_frames=None):
+        """Render a midi object chunk by chunk, yield (n_frames, 2) int16 arrays.
+
+        Parameters
+        ----------
+        midi_obj : miditoolkit.midi.parser.MidiFile
+            The source midi obj, it is not modified.
+        program : int
+            MIDI program to play every non-drum instrument with, None keeps the
+            program of each instrument.
+        tail : float
+            Seconds rendered after the last event to let notes ring out.
+        chunk_frames : int
+            Max frames of a yielded chunk, None yields the whole gap between events.
+        """
+        programs, events = midi_events(midi_obj, program)
+        self.synth.system_reset()
+        for channel, channel_program in programs.items():
+            self.synth.program_select(channel, self.sfid, 0, channel_program)
+        if DRUM_CHANNEL not in programs:
+            self.synth.program_select(DRUM_CHANNEL, self.sfid, 128, 0)
+
+        frame = 0
+        for seconds, kind, channel, a, b in events:
+            target = int(round(seconds * self.sample_rate))
+            if target > frame:
+                yield from self._read_chunks(target - frame, chunk_frames)
+                frame = target
+            if kind == NOTE_ON:
+                self.synth.noteon(channel, a, b)
+            elif kind == NOTE_OFF:
+                self.synth.noteoff(channel, a)
+            else:
+                self.synth.cc(channel, a, b)
+        yield from self._read_chunks(int(tail * self.sample_rate), chunk_frames)
+
+    def _read_chunks(self, n_frames, chunk_frames):
+        if chunk_frames is None:
+            chunk_frames = n_frames
+        while n_frames > 0:
+            size = min(n_frames, chunk_frames)
+            yield self._read(size)
+            n_frames -= size
+
+    def close(self):
+        self.synth.delete()
+
+
+def midi_duration(midi_obj, tail=1.0):
+    """Seconds of audio `MidiRenderer.render` produces for a midi object."""
+    return float(tick_to_time_mapping(midi_obj)[-1]) + tail
+
+
+_local = threading.local()
+
+
+def get_renderer(soundfont=DEFAULT_SOUNDFONT, sample_rate=SAMPLE_RATE):
+    """Return the renderer of the current thread, the soundfont is only loaded once per thread."""
+    renderers = getattr(_local, "renderers", None)
+    if renderers is None:
+        renderers = _local.renderers = {}
+    key = (soundfont, sample_rate)
+    if key not in renderers:
+        renderers[key] = MidiRenderer(soundfont, sample_rate)
+    return renderers[key]
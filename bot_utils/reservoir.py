@@ -0,0 +1,139 @@
+import os
+import asyncio
+import logging
+from collections import deque
+
+from bot_utils.inference_pool import InferenceQueueFull
+from bot_utils.storage_manager import rendered_files
+
+logger = logging.getLogger("lofi_transformer")
+
+RESERVOIR_DIR_NAME = "reservoir"
+
+
+def song_files(mid_path, mp3_path):
+    """The midi file of a song and every existing file rendered from it."""
+    return [mid_path] + [path for path in rendered_files(mp3_path) if os.path.exists(path)]
+
+
+class SongReservoir:
+    """Pre-generated songs ready to play for each (model, instrument) pair.
+
+    Songs are generated into `<gen_dir>/reservoir` by a background task while the
+    inference pool is idle, and moved into `gen_dir` when taken, so they go through
+    the same listing and voting path as songs generated on demand. Pairs that are
+    requested more often are refilled first. Each model keeps up to
+    `reservoir_depth` songs per instrument (`reservoir.depth` by default) and
+    refilling stops when the reservoir files take more than `disk_budget_mb`.
+    """
+
+    def __init__(self, config, inference):
+        reservoir_config = config.get("reservoir", {})
+        self.config = config
+        self.inference = inference
+        self.enabled = reservoir_config.get("enabled", False)
+        self.default_depth = int(reservoir_config.get("depth", 2))
+        self.disk_budget = int(reservoir_config.get("disk_budget_mb", 512) * 1024 * 1024)
+        self.refill_interval = reservoir_config.get("refill_interval", 5)
+        self.demand_decay = reservoir_config.get("demand_decay", 0.99)
+        self.songs = {}
+        self.demand = {}
+        self.bytes = 0
+        self._task = None
+        self._restore()
+
+    def reservoir_dir(self, model):
+        return os.path.join(self.config["model_selection"][model]["gen_dir"], RESERVOIR_DIR_NAME)
+
+    def depth(self, model):
+        return int(self.config["model_selection"][model].get("reservoir_depth", self.default_depth))
+
+    def _restore(self):
+        """Pick up songs left in reservoir folders by the last run."""
+        for model in self.config["model_selection"].keys():
+            reservoir_dir = self.reservoir_dir(model)
+            if not os.path.isdir(reservoir_dir):
+                continue
+            for filename in sorted(os.listdir(reservoir_dir)):
+                if not filename.endswith(".mp3"):
+                    continue
+                song_id = filename.split(".")[0]
+                code, _, instrument = song_id.partition("_")
+                mid_path = os.path.join(reservoir_dir, code+".mid")
+                # Skip leftovers that aren't songs of the reservoir, like a copied file.
+                if instrument.isdigit() and os.path.exists(mid_path):
+                    self._add(model, int(instrument), (mid_path, os.path.join(reservoir_dir, filename)))
+
+    def _add(self, model, instrument, path):
+        self.songs.setdefault((model, instrument), deque()).append(path)
+        self.bytes += sum(os.path.getsize(p) for p in song_files(*path))
+
+    def take(self, model, instrument):
+        """Move the next ready song of a pair into its gen_dir, return its mid and mp3 path or None."""
+        key = (model, int(instrument))
+        self.demand[key] = self.demand.get(key, 0) + 1
+        songs = self.songs.get(key)
+        if not songs:
+            return None
+        mid_path, mp3_path = songs.popleft()
+        files = song_files(mid_path, mp3_path)
+        self.bytes -= sum(os.path.getsize(p) for p in files)
+        gen_dir = self.config["model_selection"][model]["gen_dir"]
+        for path in files:
+            os.replace(path, os.path.join(gen_dir, os.path.basename(path)))
+        moved = tuple(os.path.join(gen_dir, os.path.basename(path)) for path in (mid_path, mp3_path))
+        logger.debug(f"Took {moved[1]} from reservoir, {len(songs)} left for {key}.")
+        return moved
+
+    def _next_pair(self):
+        """The pair that misses the most songs, weighted by how often it is requested."""
+        current = (self.config["current_model"], int(self.config["instrument"]))
+        candidates = set(self.demand.keys()) | {current}
+        best, best_priority = None, 0
+        for key in candidates:
+            model, instrument = key
+            if model not in self.config["model_selection"]:
+                continue
+            missing = self.depth(model) - len(self.songs.get(key, ()))
+            if missing <= 0:
+                continue
+            priority = missing * (1 + self.demand.get(key, 0))
+            if priority > best_priority:
+                best, best_priority = key, priority
+        return best
+
+    async def refill_loop(self):
+        while True:
+            await asyncio.sleep(self.refill_interval)
+            for key in self.demand:
+                self.demand[key] *= self.demand_decay
+            # Only use idle time, user requests go first.
+            if self.inference.pending > 0 or self.bytes >= self.disk_budget:
+                continue
+            key = self._next_pair()
+            if key is None:
+                continue
+            model, instrument = key
+            try:
+                path = await self.inference.generate(
+                    ckpt=self.config["model_selection"][model]["ckpt_path"],
+                    out=self.reservoir_dir(model),
+                    instrument=instrument,
+                    model=model
+                )
+            except InferenceQueueFull:
+                continue
+            except Exception as e:
+                logger.error(f"Reservoir refill failed for {key}.\n{e}")
+                continue
+            self._add(model, instrument, path)
+            logger.debug(f"Reservoir refilled {key}, {len(self.songs[key])} songs ready.")
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self.refill_loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
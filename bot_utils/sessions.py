@@ -0,0 +1,131 @@
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from bot_utils.metrics import get_metrics
+
+LOOP_DIR = "./loop_file"
+
+
+class PlayerSession:
+    """Player state of one guild: model, instrument, loop queue and last played files."""
+
+    def __init__(self, guild_id, config):
+        self.guild_id = guild_id
+        self.config = config
+        self.instrument = int(config["instrument"])
+        self.queue = []
+        self.keep_looping = False
+        # Number of times the loop queue was cleared, a loop compares it to know if it was cleared while playing.
+        self.clears = 0
+        self.lastfile = None
+        self.play_task = None
+        self.queue_changed = asyncio.Condition()
+        self.select_model(config["current_model"])
+
+    def select_model(self, model):
+        self.model = model
+        self.ckpt = self.config["model_selection"][model]["ckpt_path"]
+        self.out_dir = self.config["model_selection"][model]["gen_dir"]
+
+    @property
+    def loop_dir(self):
+        """Loop songs are deleted after play, each guild keeps them in its own folder."""
+        return f"{LOOP_DIR}/{self.guild_id}"
+
+    async def put_songs(self, paths):
+        async with self.queue_changed:
+            self.queue.extend(paths)
+            self.queue_changed.notify_all()
+
+    async def next_song(self):
+        """Wait for the next song of the loop queue, return None once the loop is stopped."""
+        async with self.queue_changed:
+            await self.queue_changed.wait_for(lambda: self.queue or not self.keep_looping)
+            if not self.keep_looping:
+                return None
+            path = self.queue.pop(0)
+            self.queue_changed.notify_all()
+            return path
+
+    async def wait_for_room(self, size):
+        """Wait until the loop queue has less than `size` songs, return False if the loop is stopped."""
+        async with self.queue_changed:
+            await self.queue_changed.wait_for(lambda: len(self.queue) < size or not self.keep_looping)
+            return self.keep_looping
+
+    async def stop_loop(self, clear=False):
+        async with self.queue_changed:
+            self.keep_looping = False
+            if clear:
+                self.queue = []
+                self.clears += 1
+            self.queue_changed.notify_all()
+
+
+class GenerationScheduler:
+    """Hand out generation slots to sessions in turn under a global cap.
+
+    Each session waits in its own queue, and a freed slot goes to the next session
+    in round-robin order, so a guild with many pending songs can't starve the
+    others.
+    """
+
+    def __init__(self, slots=1):
+        self.slots = int(slots)
+        self.running = 0
+        self._waiting = OrderedDict()
+
+    async def acquire(self, key):
+        if self.running < self.slots and not self._waiting:
+            self.running += 1
+            get_metrics().set("lofi_generation_slots_busy", self.running)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(key, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted right before being cancelled, hand the slot on.
+                self.release()
+            else:
+                self._discard(key, future)
+            raise
+
+    def release(self):
+        self.running -= 1
+        self._grant()
+        get_metrics().set("lofi_generation_slots_busy", self.running)
+
+    def _grant(self):
+        while self.running < self.slots and self._waiting:
+            key, futures = next(iter(self._waiting.items()))
+            future = futures.popleft()
+            if futures:
+                self._waiting.move_to_end(key)
+            else:
+                del self._waiting[key]
+            if future.done():
+                continue
+            self.running += 1
+            future.set_result(None)
+
+    def _discard(self, key, future):
+        futures = self._waiting.get(key)
+        if futures is None:
+            return
+        try:
+            futures.remove(future)
+        except ValueError:
+            pass
+        if not futures:
+            del self._waiting[key]
+
+    @asynccontextmanager
+    async def slot(self, key):
+        await self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release()
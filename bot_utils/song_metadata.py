@@ -0,0 +1,138 @@
+import os
+import json
+import struct
+import threading
+
+META_SUFFIX = ".meta.json"
+
+# Layer III bitrates in kbps, indexed by the bitrate bits of the frame header.
+MPEG1_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+MPEG2_BITRATES = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+MPEG1_SAMPLE_RATES = [44100, 48000, 32000]
+# Bytes read to look for the first frame after the ID3 tag.
+PROBE_SIZE = 64 * 1024
+
+
+def metadata_path(audio_path):
+    """Sidecar file of a song, `<code>_<instrument>.meta.json` next to the audio."""
+    return os.path.splitext(audio_path)[0] + META_SUFFIX
+
+
+def write_song_metadata(audio_path, duration, sample_rate, midi_obj=None, model=None, instrument=None):
+    """Write the sidecar of a rendered song, return the metadata dict."""
+    metadata = {
+        "id": os.path.basename(audio_path).split(".")[0],
+        "duration": float(duration),
+        "sample_rate": int(sample_rate),
+        "note_count": None,
+        "tempo": None,
+        "model": model,
+        "instrument": None if instrument is None else int(instrument),
+        "file_size": os.path.getsize(audio_path),
+    }
+    if midi_obj is not None:
+        metadata["note_count"] = sum(len(inst.notes) for inst in midi_obj.instruments)
+        if midi_obj.tempo_changes:
+            metadata["tempo"] = float(midi_obj.tempo_changes[0].tempo)
+    path = metadata_path(audio_path)
+    # Write then rename, readers never see a partial sidecar.
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(temp_path, "w") as f:
+        json.dump(metadata, f)
+    os.replace(temp_path, path)
+    return metadata
+
+
+def probe_mp3(file_path):
+    """Read duration and sample rate of an mp3 from its headers only.
+
+    Use the frame count of the Xing/Info or VBRI header written by LAME, and fall
+    back to file size over bitrate for constant bitrate files without one.
+
+    Return
+    ------
+    float, int
+        Duration in seconds and sample rate, or None if no mp3 frame is found.
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        header = f.read(10)
+        offset = 0
+        if header[:3] == b"ID3" and len(header) == 10:
+            size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+            offset = 10 + size + (10 if header[5] & 0x10 else 0)
+        f.seek(offset)
+        data = f.read(PROBE_SIZE)
+
+    for i in range(len(data) - 4):
+        if data[i] != 0xFF or (data[i + 1] & 0xE0) != 0xE0:
+            continue
+        version = (data[i + 1] >> 3) & 0x3
+        layer = (data[i + 1] >> 1) & 0x3
+        bitrate_index = data[i + 2] >> 4
+        sample_rate_index = (data[i + 2] >> 2) & 0x3
+        # Only Layer III with valid bitrate and sample rate.
+        if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+            continue
+        is_mpeg1 = version == 3
+        sample_rate = MPEG1_SAMPLE_RATES[sample_rate_index] // {3: 1, 2: 2, 0: 4}[version]
+        bitrate = (MPEG1_BITRATES if is_mpeg1 else MPEG2_BITRATES)[bitrate_index] * 1000
+        samples_per_frame = 1152 if is_mpeg1 else 576
+        mono = (data[i + 3] >> 6) == 3
+
+        side_info = (17 if mono else 32) if is_mpeg1 else (9 if mono else 17)
+        xing = i + 4 + side_info
+        if data[xing:xing + 4] in (b"Xing", b"Info"):
+            flags = struct.unpack(">I", data[xing + 4:xing + 8])[0]
+            if flags & 0x1:
+                frames = struct.unpack(">I", data[xing + 8:xing + 12])[0]
+                return frames * samples_per_frame / sample_rate, sample_rate
+        vbri = i + 4 + 32
+        if data[vbri:vbri + 4] == b"VBRI":
+            frames = struct.unpack(">I", data[vbri + 14:vbri + 18])[0]
+            return frames * samples_per_frame / sample_rate, sample_rate
+        return (file_size - offset - i) * 8 / bitrate, sample_rate
+    return None
+
+
+class SongMetadataStore:
+    """Per song metadata read from sidecars, cached in memory.
+
+    Songs without a sidecar are probed from their mp3 headers and get a sidecar
+    written, so later lookups are a dict access.
+    """
+
+    def __init__(self):
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get(self, audio_path):
+        with self._lock:
+            if audio_path in self._cache:
+                return self._cache[audio_path]
+        path = metadata_path(audio_path)
+        metadata = None
+        if os.path.exists(path):
+            with open(path) as f:
+                metadata = json.load(f)
+        elif os.path.exists(audio_path):
+            probed = probe_mp3(audio_path)
+            if probed is not None:
+                duration, sample_rate = probed
+                metadata = write_song_metadata(audio_path, duration, sample_rate)
+        if metadata is not None:
+            with self._lock:
+                self._cache[audio_path] = metadata
+        return metadata
+
+    def forget(self, audio_path):
+        with self._lock:
+            self._cache.pop(audio_path, None)
+
+
+_store = SongMetadataStore()
+
+
+def get_song_metadata(audio_path):
+    """Metadata of a song from the process-wide store, None if it can't be read."""
+    return _store.get(audio_path)
@@ -0,0 +1,79 @@
+import sys
+import time
+import builtins
+import threading
+from collections import Counter
+
+# Packages that should only be imported by the inference workers or on first use.
+HEAVY_PACKAGES = ("torch", "scipy", "miditoolkit", "midi2audio", "pydub", "models", "saver", "fluidsynth")
+
+
+class StartupProfile:
+    """Time the phases of the bot startup and the imports done before it is ready.
+
+    While installed, the profile wraps `__import__` of the main thread and adds
+    the time spent importing each module to its top-level package, minus the time
+    of the other packages it imports. `mark` records the end of a startup phase.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks = []
+        self.imports = Counter()
+        self._nested = []
+        self._original_import = None
+
+    def install(self):
+        if self._original_import is None:
+            self._original_import = builtins.__import__
+            builtins.__import__ = self._import
+
+    def uninstall(self):
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        original = self._original_import or builtins.__import__
+        if level or name in sys.modules or threading.current_thread() is not threading.main_thread():
+            return original(name, globals, locals, fromlist, level)
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.imports[name.partition(".")[0]] += elapsed - self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+
+    def mark(self, phase):
+        self.marks.append((phase, time.perf_counter()))
+
+    def phases(self):
+        """(phase, seconds) of every mark since the previous one."""
+        phases = []
+        last = self.start
+        for phase, at in self.marks:
+            phases.append((phase, at - last))
+            last = at
+        return phases
+
+    def elapsed(self):
+        return (self.marks[-1][1] if self.marks else time.perf_counter()) - self.start
+
+    def heavy_imports(self):
+        """Heavy packages loaded in this process so far."""
+        return [package for package in HEAVY_PACKAGES if package in sys.modules]
+
+    def summary(self, top=8):
+        phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases())
+        imports = ", ".join(f"{package} {seconds:.2f}s" for package, seconds in self.imports.most_common(top))
+        lines = [
+            f"Ready in {self.elapsed():.2f}s ({phases}).",
+            f"Import time {sum(self.imports.values()):.2f}s, slowest: {imports}.",
+        ]
+        heavy = self.heavy_imports()
+        if heavy:
+            lines.append(f"Heavy packages imported before ready: {', '.join(heavy)}.")
+        return "\n".join(lines)
@@ -0,0 +1,235 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter
+
+from bot_utils.metrics import get_metrics
+from bot_utils.song_metadata import META_SUFFIX
+
+logger = logging.getLogger("lofi_transformer")
+
+# Files derived from a midi file, they can be rendered again and are the ones evicted.
+RENDER_SUFFIXES = (".mp3", ".ogg", ".flac", META_SUFFIX)
+
+
+def rendered_files(mp3_path):
+    """The mp3 of a song and the other outputs and sidecar written next to it."""
+    base = os.path.splitext(mp3_path)[0]
+    return [base + suffix for suffix in RENDER_SUFFIXES]
+
+
+class FileHolds:
+    """Files that an audio source has open, counted per path.
+
+    Playback holds its files until the `after` callback of the voice client,
+    the storage manager and loop cleanup never delete a held file.
+    """
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def hold(self, *paths):
+        with self._lock:
+            self._counts.update(os.path.normpath(path) for path in paths)
+
+    def release(self, *paths):
+        with self._lock:
+            for path in paths:
+                path = os.path.normpath(path)
+                self._counts[path] -= 1
+                if self._counts[path] <= 0:
+                    del self._counts[path]
+
+    def held(self, path):
+        with self._lock:
+            return os.path.normpath(path) in self._counts
+
+
+class StorageManager:
+    """Keep the renders of each model under its disk budget.
+
+    The manager tracks the size of every song of the library and works in small
+    steps from a background task: each step sizes at most `scan_batch` new
+    songs, and evicts at most `batch` songs of a folder over its budget once all
+    its songs are sized. The file system work of a step runs in a thread, the
+    vote query and library changes run on the event loop, which owns the vote
+    store connection and iterates the library. Songs are evicted lowest score first, then fewest
+    views, then oldest. Only the mp3 and the files derived from it are deleted,
+    the midi file is kept so the song can be rendered again. Songs newer than
+    `min_age` seconds and files held by a voice source are never deleted.
+
+    Loop songs are removed after they are played. Files left in the loop folder
+    for more than `loop_max_age` seconds, e.g. by a loop that never resumed,
+    are swept in the same steps.
+    """
+
+    def __init__(self, library, votes, budgets, holds, loop_dir="./loop_file", interval=60, batch=200, scan_batch=2000, min_age=3600, loop_max_age=6 * 3600):
+        self.library = library
+        self.votes = votes
+        # gen_dir to (model, byte budget).
+        self.budgets = {os.path.normpath(gen_dir): budget for gen_dir, budget in budgets.items()}
+        self.holds = holds
+        self.loop_dir = loop_dir
+        self.interval = interval
+        self.batch = int(batch)
+        self.scan_batch = int(scan_batch)
+        self.min_age = min_age
+        self.loop_max_age = loop_max_age
+        # gen_dir to {song id: (mp3 path, bytes, mtime)}.
+        self._sizes = {gen_dir: {} for gen_dir in self.budgets}
+        self._bytes = Counter()
+        # mp3 paths deleted by the thread, removed from the library on the event loop.
+        self._removed = []
+        self._task = None
+
+    @classmethod
+    def from_config(cls, config, library, votes, holds):
+        storage_config = config.get("storage", {})
+        default_mb = storage_config.get("budget_mb", 2048)
+        budgets = {
+            setting["gen_dir"]: (model, int(setting.get("disk_budget_mb", default_mb) * 1024 * 1024))
+            for model, setting in config["model_selection"].items()
+        }
+        return cls(
+            library, votes, budgets, holds,
+            interval=storage_config.get("interval", 60),
+            batch=storage_config.get("batch", 200),
+            scan_batch=storage_config.get("scan_batch", 2000),
+            min_age=storage_config.get("min_age", 3600),
+            loop_max_age=storage_config.get("loop_max_age", 6 * 3600),
+        )
+
+    def bytes(self, gen_dir):
+        return self._bytes[os.path.normpath(gen_dir)]
+
+    def step(self):
+        """Run one increment of sizing, eviction and loop sweep, return the number of deleted songs."""
+        over_budget = self.scan()
+        self.forget_removed()
+        deleted = self.evict({gen_dir: self.votes.song_values(self.budgets[gen_dir][0]) for gen_dir in over_budget})
+        self.forget_removed()
+        return deleted
+
+    def forget_removed(self):
+        """Remove the songs deleted by `scan` and `evict` from the library, call it on the event loop."""
+        removed, self._removed = self._removed, []
+        for mp3_path in removed:
+            self.library.remove(mp3_path)
+
+    def scan(self):
+        """Size new songs of every folder, return the folders to evict from."""
+        over_budget = []
+        for gen_dir, (model, budget) in self.budgets.items():
+            unsized = self._update_sizes(gen_dir)
+            if unsized == 0 and self._bytes[gen_dir] > budget:
+                over_budget.append(gen_dir)
+            get_metrics().set("lofi_storage_bytes", self._bytes[gen_dir], model=model)
+        return over_budget
+
+    def evict(self, values):
+        """Evict from each folder of `values`, the {song id: (score, view)} of its model, then sweep the loop folder."""
+        deleted = 0
+        for gen_dir, song_values in values.items():
+            model, budget = self.budgets[gen_dir]
+            deleted += self._evict(gen_dir, model, budget, song_values)
+            get_metrics().set("lofi_storage_bytes", self._bytes[gen_dir], model=model)
+        self._sweep_loop_dir()
+        return deleted
+
+    def _update_sizes(self, gen_dir):
+        """Forget songs that left the library, size up to `scan_batch` songs that joined it.
+
+        Return the number of songs left to size.
+        """
+        songs = self.library.snapshot(gen_dir)
+        sizes = self._sizes[gen_dir]
+        for song_id in [song_id for song_id in sizes if song_id not in songs]:
+            self._bytes[gen_dir] -= sizes.pop(song_id)[1]
+        new_ids = [song_id for song_id in songs if song_id not in sizes]
+        for song_id in new_ids[:self.scan_batch]:
+            mp3_path = songs[song_id][1]
+            size, mtime = 0, None
+            for path in rendered_files(mp3_path):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                size += stat.st_size
+                if path == mp3_path:
+                    mtime = stat.st_mtime
+            if mtime is None:
+                # Deleted behind the bot's back.
+                self._removed.append(mp3_path)
+                continue
+            sizes[song_id] = (mp3_path, size, mtime)
+            self._bytes[gen_dir] += size
+        return max(len(new_ids) - self.scan_batch, 0)
+
+    def _evict(self, gen_dir, model, budget, values):
+        now = time.time()
+        sizes = self._sizes[gen_dir]
+        candidates = sorted(
+            (song_id for song_id, (_, _, mtime) in sizes.items() if now - mtime >= self.min_age),
+            key=lambda song_id: values.get(song_id, (0, 0)) + (sizes[song_id][2],),
+        )
+        deleted = 0
+        for song_id in candidates:
+            if self._bytes[gen_dir] <= budget or deleted >= self.batch:
+                break
+            mp3_path, size, _ = sizes[song_id]
+            paths = rendered_files(mp3_path)
+            if any(self.holds.held(path) for path in paths):
+                continue
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._removed.append(mp3_path)
+            del sizes[song_id]
+            self._bytes[gen_dir] -= size
+            deleted += 1
+        if deleted:
+            get_metrics().inc("lofi_storage_evicted_total", deleted, model=model)
+            logger.info(f"Evicted {deleted} renders of {model}, {self._bytes[gen_dir] / 1024 / 1024:.0f}MB left in {gen_dir}.")
+        return deleted
+
+    def _sweep_loop_dir(self):
+        if not os.path.isdir(self.loop_dir):
+            return
+        now = time.time()
+        swept = 0
+        for entry in os.scandir(self.loop_dir):
+            if not entry.is_dir():
+                continue
+            for file in os.scandir(entry.path):
+                if swept >= self.batch:
+                    return
+                if file.is_file() and now - file.stat().st_mtime > self.loop_max_age and not self.holds.held(file.path):
+                    os.remove(file.path)
+                    swept += 1
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                over_budget = await loop.run_in_executor(None, self.scan)
+                self.forget_removed()
+                values = {gen_dir: self.votes.song_values(self.budgets[gen_dir][0]) for gen_dir in over_budget}
+                await loop.run_in_executor(None, self.evict, values)
+                self.forget_removed()
+            except Exception as e:
+                logger.error(f"Storage step failed.\n{e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,105 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import discord
+import numpy as np
+
+from bot_utils.renderer import DEFAULT_SOUNDFONT, get_renderer, midi_duration
+from bot_utils.mastering import Mastering, get_mastering_settings
+from bot_utils.encoder_pool import get_encoder_pool, with_mp3
+from bot_utils.song_metadata import write_song_metadata
+
+logger = logging.getLogger("lofi_transformer")
+
+# discord.py plays 20ms frames of 48kHz 16-bit stereo PCM.
+SAMPLE_RATE = 48000
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+CHUNK_FRAMES = SAMPLE_RATE // 10
+# A stream that isn't archived drops the played part of its buffer once it is this long, 1s of audio.
+TRIM_BYTES = SAMPLE_RATE * 4
+
+# Long-lived threads, so each keeps its synthesizer and soundfont loaded between songs.
+_render_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="stream-render")
+
+
+class StreamingMidiSource(discord.AudioSource):
+    """Play a midi file while it is being synthesized.
+
+    A render thread pushes PCM chunks into a buffer as fast as FluidSynth produces
+    them, `read` hands them to the voice client as soon as the first 20ms frame is
+    ready. When `archive_path` is given, the whole stream is encoded to mp3 and the
+    other configured outputs once synthesis is done, otherwise the played part
+    of the buffer is dropped as the song plays. Chunks go through `Mastering` on their
+    way to the buffer, with the process-wide settings unless `mastering` is given.
+    """
+
+    def __init__(self, mid_path, program, archive_path=None, soundfont=DEFAULT_SOUNDFONT, mastering=None, model=None):
+        self.mid_path = mid_path
+        self.model = model
+        self.program = int(program)
+        self.archive_path = archive_path
+        self.soundfont = soundfont
+        self.mastering = Mastering(SAMPLE_RATE, mastering or get_mastering_settings())
+        # Imported on first play, so the bot doesn't load it at startup.
+        from miditoolkit.midi.parser import MidiFile
+        self.midi_obj = MidiFile(mid_path)
+        self.duration = midi_duration(self.midi_obj)
+
+        self._buffer = bytearray()
+        self._position = 0
+        self._done = False
+        self._cancelled = False
+        self._condition = threading.Condition()
+        self.archived = _render_executor.submit(self._produce)
+
+    def _produce(self):
+        try:
+            renderer = get_renderer(self.soundfont, SAMPLE_RATE)
+            for chunk in renderer.stream(self.midi_obj, program=self.program, chunk_frames=CHUNK_FRAMES):
+                # Keep rendering a stopped song when it still has to be archived.
+                if self._cancelled and self.archive_path is None:
+                    break
+                chunk = self.mastering.process(chunk).tobytes()
+                with self._condition:
+                    self._buffer.extend(chunk)
+                    self._condition.notify_all()
+        except Exception as e:
+            logger.error(f"Streaming render of {self.mid_path} failed.\n{e}")
+            return None
+        finally:
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+
+        if self.archive_path is not None:
+            self._archive()
+        return self.archive_path
+
+    def _archive(self):
+        with self._condition:
+            pcm = np.frombuffer(bytes(self._buffer), dtype=np.int16).reshape(-1, 2)
+        pool = get_encoder_pool()
+        report = pool.encode(pcm, SAMPLE_RATE, self.archive_path, with_mp3(pool.outputs), model=self.model)
+        write_song_metadata(self.archive_path, report["audio_seconds"], SAMPLE_RATE, self.midi_obj, self.model, self.program)
+        logger.debug(f"{self.archive_path} archived from stream.")
+
+    def read(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._done or len(self._buffer) - self._position >= FRAME_SIZE)
+            frame = bytes(self._buffer[self._position:self._position + FRAME_SIZE])
+            self._position += len(frame)
+            if self.archive_path is None and self._position >= TRIM_BYTES:
+                del self._buffer[:self._position]
+                self._position = 0
+        if not frame:
+            return b''
+        if len(frame) < FRAME_SIZE:
+            frame += b'\x00' * (FRAME_SIZE - len(frame))
+        return frame
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self._cancelled = True
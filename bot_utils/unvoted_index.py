@@ -0,0 +1,99 @@
+import random
+
+# Random draws before falling back to scanning the bitmap of a user.
+MAX_TRIES = 32
+MAX_VOTE = 5
+
+
+class UserVotes:
+    """Bitmap over song ordinals of the songs a user has voted."""
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+
+    def has(self, ordinal):
+        byte = ordinal >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (ordinal & 7)))
+
+    def add(self, ordinal):
+        if self.has(ordinal):
+            return
+        byte = ordinal >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        self.bits[byte] |= 1 << (ordinal & 7)
+        self.count += 1
+
+    def unvoted(self, n_songs):
+        """Ordinals below `n_songs` not in the bitmap, skipping full bytes."""
+        ordinals = []
+        for byte in range((n_songs + 7) >> 3):
+            value = self.bits[byte] if byte < len(self.bits) else 0
+            if value == 0xFF:
+                continue
+            for bit in range(8):
+                ordinal = (byte << 3) | bit
+                if ordinal < n_songs and not value & (1 << bit):
+                    ordinals.append(ordinal)
+        return ordinals
+
+
+class UnvotedIndex:
+    """Songs of a model each user hasn't voted yet, for picking one at random.
+
+    Songs get a dense ordinal in the order they are first voted, and each user has
+    a bitmap of the ordinals they voted. A pick draws random ordinals until one is
+    unvoted, which takes a constant expected number of draws unless the user voted
+    almost everything; then the bitmap is scanned instead. With `score_bias > 0`
+    a draw is accepted with probability `(score / 5) ** score_bias`, so better
+    rated songs come up more often.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.ordinals = {}
+        self.scores = []
+        self.users = {}
+
+    def _ordinal(self, id):
+        ordinal = self.ordinals.get(id)
+        if ordinal is None:
+            ordinal = len(self.ids)
+            self.ordinals[id] = ordinal
+            self.ids.append(id)
+            self.scores.append(None)
+        return ordinal
+
+    def set_score(self, id, score):
+        """Add a song or update its score."""
+        self.scores[self._ordinal(id)] = score
+
+    def add_vote(self, user, id):
+        self.users.setdefault(user, UserVotes()).add(self._ordinal(id))
+
+    def weight(self, ordinal, score_bias):
+        if score_bias == 0:
+            return 1.0
+        score = self.scores[ordinal]
+        if score is None:
+            score = (1 + MAX_VOTE) / 2
+        return (max(score, 0) / MAX_VOTE) ** score_bias
+
+    def pick(self, user, score_bias=0):
+        """Id of a random song the user hasn't voted, or None if there is none."""
+        n_songs = len(self.ids)
+        votes = self.users.get(user, UserVotes())
+        if votes.count >= n_songs:
+            return None
+        for _ in range(MAX_TRIES):
+            ordinal = random.randrange(n_songs)
+            if votes.has(ordinal):
+                continue
+            if score_bias == 0 or random.random() < self.weight(ordinal, score_bias):
+                return self.ids[ordinal]
+        ordinals = votes.unvoted(n_songs)
+        weights = [self.weight(ordinal, score_bias) for ordinal in ordinals]
+        if sum(weights) <= 0:
+            weights = None
+        return self.ids[random.choices(ordinals, weights=weights)[0]]
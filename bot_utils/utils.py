@@ -1,6 +1,7 @@
 import os
 import pretty_midi
-from pydub import AudioSegment
+from bot_utils.song_metadata import get_song_metadata
+from bot_utils.library_index import scan_dir
 
 # Extend this to add more selection.
 midi_program_to_emoji = {
@@ -21,23 +22,28 @@ def get_instrument_emoji(instrument: int):
 
 
 def getfiles(out_dir):
-    """Get playable audio source and midi in generate folder."""    
+    """Get playable audio source and midi in generate folder."""
     os.makedirs(out_dir, exist_ok=True)
-    filenames = os.listdir(out_dir)
-    codes = [filename.split(".")[0] for filename in filenames if filename.endswith(".mid")]
-    filedict = {}
-    for c in codes:
-        audios = [filename for filename in filenames if filename.startswith(c) and filename.endswith(".mp3")]
-        for a in audios:
-            filename = a.split(".")[0]
-            mid_path = os.path.join(out_dir, c+".mid")
-            mp3_path = os.path.join(out_dir, a)
-            filedict[filename] = [mid_path, mp3_path]
-    return filedict
+    return scan_dir(out_dir)
 
-def get_audio_time(file_path):
-    """Get mp3 audio length in %m:%s format."""
-    duration = AudioSegment.from_mp3(file_path).duration_seconds
+def format_audio_time(duration):
+    """Format seconds in %m:%s format."""
     minute = int(duration // 60)
     second = int(duration % 60)
-    return f"{minute:02d}:{second:02d}"
\ No newline at end of file
+    return f"{minute:02d}:{second:02d}"
+
+def get_audio_time(file_path):
+    """Get mp3 audio length in %m:%s format, from the song metadata sidecar or mp3 headers.
+
+    Return None when neither exists, e.g. for a song evicted by the storage manager.
+    """
+    metadata = get_song_metadata(file_path)
+    if metadata is not None:
+        duration = metadata["duration"]
+    elif not os.path.exists(file_path):
+        return None
+    else:
+        # Only songs without a sidecar need pydub, don't import it at startup.
+        from pydub import AudioSegment
+        duration = AudioSegment.from_mp3(file_path).duration_seconds
+    return format_audio_time(duration)
\ No newline at end of file
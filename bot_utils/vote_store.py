@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+
+from bot_utils.unvoted_index import UnvotedIndex
+
+logger = logging.getLogger("lofi_transformer")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    model TEXT NOT NULL,
+    id TEXT NOT NULL,
+    code TEXT NOT NULL,
+    instrument INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    time TEXT,
+    view INTEGER NOT NULL DEFAULT 0,
+    vote_sum INTEGER NOT NULL DEFAULT 0,
+    vote_count INTEGER NOT NULL DEFAULT 0,
+    score REAL,
+    PRIMARY KEY (model, id)
+);
+CREATE INDEX IF NOT EXISTS songs_ranking ON songs (model, score DESC);
+CREATE TABLE IF NOT EXISTS votes (
+    model TEXT NOT NULL,
+    id TEXT NOT NULL,
+    user TEXT NOT NULL,
+    vote INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS votes_user ON votes (model, user, id);
+CREATE TABLE IF NOT EXISTS migrations (
+    name TEXT PRIMARY KEY,
+    applied REAL NOT NULL
+);
+"""
+
+
+class VoteStore:
+    """Song votes in an SQLite database.
+
+    Votes are appended to `votes`, and each song row keeps its running vote sum,
+    count and mean score, so a vote is one insert and one update, and rankings are
+    read from the `(model, score)` index instead of averaging every song.
+    """
+
+    def __init__(self, db_path="./votes.sqlite3"):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._unvoted = {}
+
+    @classmethod
+    def from_config(cls, config):
+        store = cls(config.get("votes", {}).get("db_path", "./votes.sqlite3"))
+        for model, setting in config["model_selection"].items():
+            store.migrate_json(model, os.path.join(setting["gen_dir"], setting["statistic_json_name"]))
+        return store
+
+    def migrate_json(self, model, stats_path):
+        """Import a `song_stats.json` of the old format once, the file is left as is."""
+        name = f"song_stats:{model}"
+        if self.conn.execute("SELECT 1 FROM migrations WHERE name = ?", (name,)).fetchone() is not None:
+            return
+        song_stats = {}
+        if os.path.exists(stats_path):
+            with open(stats_path) as f:
+                song_stats = json.load(f)
+        with self.conn:
+            for id, song in song_stats.items():
+                votes = [int(rate["vote"]) for rate in song["rate"]]
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (model, id, song["code"], int(song["instrument"]), song["path"], song["time"],
+                     song["view"], sum(votes), len(votes), sum(votes) / len(votes) if votes else None)
+                )
+                self.conn.executemany(
+                    "INSERT INTO votes VALUES (?, ?, ?, ?, ?)",
+                    [(model, id, rate["user"], int(rate["vote"]), 0) for rate in song["rate"]]
+                )
+            self.conn.execute("INSERT INTO migrations VALUES (?, ?)", (name, time.time()))
+        if song_stats:
+            logger.info(f"Migrated {len(song_stats)} songs of {model} from {stats_path}.")
+
+    def record_vote(self, model, id, path, audio_time, user, vote):
+        """Add a vote of a user on a song, creating the song row on its first vote."""
+        code, instrument = id.split("_")
+        vote = int(vote)
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, 1, ?, 1, ?) "
+                "ON CONFLICT (model, id) DO UPDATE SET "
+                "view = view + 1, vote_sum = vote_sum + excluded.vote_sum, vote_count = vote_count + 1, "
+                "score = CAST(vote_sum + excluded.vote_sum AS REAL) / (vote_count + 1)",
+                (model, id, code, int(instrument), path, audio_time, vote, float(vote))
+            )
+            self.conn.execute("INSERT INTO votes VALUES (?, ?, ?, ?, ?)", (model, id, user, vote, time.time()))
+        if model in self._unvoted:
+            score = self.conn.execute("SELECT score FROM songs WHERE model = ? AND id = ?", (model, id)).fetchone()["score"]
+            self._unvoted[model].set_score(id, score)
+            self._unvoted[model].add_vote(user, id)
+
+    def top_k(self, model, k=9):
+        """Best rated songs of a model, return a list of (id, score)."""
+        rows = self.conn.execute(
+            "SELECT id, score FROM songs WHERE model = ? AND score IS NOT NULL ORDER BY score DESC LIMIT ?",
+            (model, k)
+        )
+        return [(row["id"], row["score"]) for row in rows]
+
+    def song(self, model, id):
+        row = self.conn.execute("SELECT * FROM songs WHERE model = ? AND id = ?", (model, id)).fetchone()
+        return None if row is None else dict(row)
+
+    def song_values(self, model):
+        """Return {id: (score, view)} of the songs of a model, 0 for a song without score."""
+        rows = self.conn.execute("SELECT id, score, view FROM songs WHERE model = ?", (model,))
+        return {row["id"]: (row["score"] or 0, row["view"]) for row in rows}
+
+    def unvoted_index(self, model):
+        """The unvoted song index of a model, built from the database on first use."""
+        index = self._unvoted.get(model)
+        if index is None:
+            index = UnvotedIndex()
+            for row in self.conn.execute("SELECT id, score FROM songs WHERE model = ? ORDER BY rowid", (model,)):
+                index.set_score(row["id"], row["score"])
+            for row in self.conn.execute("SELECT user, id FROM votes WHERE model = ?", (model,)):
+                index.add_vote(row["user"], row["id"])
+            self._unvoted[model] = index
+        return index
+
+    def random_unvoted(self, model, user, score_bias=0):
+        """A random song of a model that the user hasn't voted, or None."""
+        id = self.unvoted_index(model).pick(user, score_bias)
+        return None if id is None else self.song(model, id)
+
+    def close(self):
+        self.conn.close()
@@ -6,14 +6,23 @@ import pretty_midi
 import discord
 import datetime
 import logging
-import random
 import asyncio
-import numpy as np
 from colorama import Fore, init
+from discord import app_commands
 from discord.ext import commands
 import assets.settings.setting as setting
-from generate import generate, render_midi_to_mp3 
-from bot_utils.utils import get_audio_time, getfiles, get_instrument_emoji
+from bot_utils.utils import get_audio_time, format_audio_time, get_instrument_emoji, midi_program_to_emoji
+from bot_utils.inference_pool import InferencePool, InferenceQueueFull
+from bot_utils.reservoir import SongReservoir
+from bot_utils.streaming import StreamingMidiSource
+from bot_utils.opus_cache import OpusCache
+from bot_utils.library_index import LibraryIndex
+from bot_utils.vote_store import VoteStore
+from bot_utils.sessions import PlayerSession, GenerationScheduler
+from bot_utils.metrics import configure_metrics, serve_metrics
+from bot_utils.mastering import configure_mastering
+from bot_utils.encoder_pool import configure_encoder
+from bot_utils.storage_manager import FileHolds, StorageManager, rendered_files
 from assets.scripts.bot_views import Rating, InstrumentSelectDropdownView, ModelSelectDropdownView
 init()
 
@@ -27,46 +36,61 @@ class LofiTransformerPlayer(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.load_config()
-        self.select_model(self.config["current_model"])
-        self.lastfile = None
-
-        self.queue = []
-        self.keep_looping = False
+        self.metrics = configure_metrics(self.config)
+        configure_mastering(self.config)
+        configure_encoder(self.config)
+        self.metrics_server = None
+        self.inference = InferencePool(self.config)
+        self.reservoir = SongReservoir(self.config, self.inference)
+        self.library = LibraryIndex.from_config(self.config)
+        self.votes = VoteStore.from_config(self.config)
+        self.holds = FileHolds()
+        self.storage = None
+        if self.config.get("storage", {}).get("enabled", False):
+            self.storage = StorageManager.from_config(self.config, self.library, self.votes, self.holds)
+        self.opus_cache = None
+        if self.config.get("opus_cache", {}).get("enabled", False):
+            self.opus_cache = OpusCache.from_config(self.config)
+        inference_config = self.config.get("inference", {})
+        self.scheduler = GenerationScheduler(inference_config.get("generation_slots", inference_config.get("workers", 1)))
+        self.sessions = {}
         logger.info("Lofi Transformer Cog loaded!")
 
-    def select_model(self, model):
-        self.config["current_model"] = model
-        self.save_config()
-        self.current_model = model
-        self.current_model_ckpt = self.config["model_selection"][self.current_model]["ckpt_path"]
-        self.out_dir = self.config["model_selection"][self.current_model]["gen_dir"]
-        self.filedict = getfiles(self.out_dir)
+    async def cog_load(self):
+        if self.config.get("registry", {}).get("warm_up", False):
+            asyncio.create_task(self.inference.start())
+        self.reservoir.start()
+        if self.storage is not None:
+            self.storage.start()
+        metrics_config = self.config.get("metrics", {})
+        if self.metrics.enabled and metrics_config.get("port"):
+            self.metrics_server = await serve_metrics(self.metrics, metrics_config.get("host", "127.0.0.1"), metrics_config["port"])
+
+    async def cog_unload(self):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        self.reservoir.stop()
+        if self.storage is not None:
+            self.storage.stop()
+        self.inference.shutdown()
+        self.library.flush()
+        self.votes.close()
+
+    async def warm_up_model(self, model):
+        """Load model in inference workers in background so the first song does not wait for it."""
+        try:
+            await self.inference.warm_up(model)
+            logger.info(f"Model {model} warmed up.")
+        except Exception as e:
+            logger.error(f"{Fore.RED}Failed to warm up {model}.{Fore.RESET}\n{e}")
+
+    def session(self, guild):
+        """Player session of a guild, created with the default model and instrument of the config."""
+        guild_id = guild.id if guild is not None else 0
+        if guild_id not in self.sessions:
+            self.sessions[guild_id] = PlayerSession(guild_id, self.config)
+        return self.sessions[guild_id]
 
-        self.load_stats()
-    
-    def load_stats(self):
-        """Load song stats from current model generation folder."""
-        assert (self.config != None) and (self.current_model != None)
-        stats_path = os.path.join(
-                self.config["model_selection"][self.current_model]["gen_dir"], 
-                self.config["model_selection"][self.current_model]["statistic_json_name"]
-        )
-        if(not os.path.exists(stats_path)):
-            self.song_stats = {}
-        else:
-            self.song_stats = json.load(open(stats_path))
-    
-    def save_stats(self):
-        """Save song stats to current model generation folder."""
-        assert (self.config != None) and (self.current_model != None)
-        stats_path = os.path.join(
-                self.config["model_selection"][self.current_model]["gen_dir"], 
-                self.config["model_selection"][self.current_model]["statistic_json_name"]
-        )
-        stats = json.dumps(self.song_stats, indent=4)
-        with open(stats_path, "w") as j:
-            j.write(stats)
-    
     def load_config(self):
         self.config = json.load(open(CONFIG_PATH))
 
@@ -81,31 +105,45 @@ class LofiTransformerPlayer(commands.Cog):
         fmt = await ctx.bot.tree.sync()
         await ctx.send(f"Synced {len(fmt)} commands to current guild.")
     
+    @commands.command(name="metrics")
+    @commands.is_owner()
+    async def _metrics(self, ctx):
+        """Show the metrics in Prometheus text format, owner only."""
+        if not self.metrics.enabled:
+            await ctx.send("Metrics are disabled.")
+            return
+        text = self.metrics.render()
+        # Discord messages are limited to 2000 characters.
+        for i in range(0, len(text), 1900):
+            await ctx.send(f"```\n{text[i:i + 1900]}```")
+
     @commands.hybrid_command(name="pick", description="Pick random song from best samples.")
     async def _pick(self, ctx):
         """Pick randomly from songs that not voted by user in current model."""
-        await self.stop_looping()
-        self.load_stats()
-        pickable_songs = []
-        for key, val in self.song_stats.items():
-            vote_list = [item["user"] for item in val["rate"]]
-            if not str(ctx.author) in vote_list:
-                pickable_songs.append(val)
-        if pickable_songs == []:
+        session = self.session(ctx.guild)
+        await self.stop_looping(session)
+        score_bias = self.config.get("votes", {}).get("pick_score_bias", 0)
+        pick = self.votes.random_unvoted(session.model, str(ctx.author), score_bias)
+        if pick is None:
             await ctx.reply(content="You have voted all songs generated by this model.")
         else:
-            pick = random.choice(pickable_songs)
             picked_mp3_path = pick["path"]
-            picked_mid_path = os.path.join(os.path.dirname(picked_mp3_path), pick["code"], ".mid") # FIXME: Bad approach.
-            await self.update_dict(ctx)
-            self.lastfile = (picked_mid_path, picked_mp3_path)
+            picked_mid_path = os.path.join(os.path.dirname(picked_mp3_path), pick["code"]+".mid")
+            if not os.path.exists(picked_mp3_path):
+                path = await self.render_evicted(session, pick["id"])
+                if path is None:
+                    await ctx.reply(content="Files not found.")
+                    return
+                picked_mid_path, picked_mp3_path = path
+            session.lastfile = (picked_mid_path, picked_mp3_path)
             await self.ensure_voice(ctx)
             await self.play_command(ctx, picked_mp3_path)
         
     @commands.hybrid_command(name="model", description="Dropdown menu to set generation model.")
     async def _model(self, ctx):
         """Show a dropdown selection to set the model to generate song."""
-        current_model = self.config["current_model"]
+        session = self.session(ctx.guild)
+        current_model = session.model
         current_model_emoji = self.config["model_selection"][current_model]["emoji"]
         model_list = self.config["model_selection"].keys()
         model_description_dict = {m: self.config["model_selection"][m]["description"] for m in model_list}
@@ -120,25 +158,22 @@ class LofiTransformerPlayer(commands.Cog):
             return
         model_emoji = self.config["model_selection"][view.value]["emoji"]
         await model_select_message.edit(content=f"Model changed to {model_emoji} **{view.value}**", view=None)
-        self.select_model(view.value)
+        session.select_model(view.value)
+        # Remember the choice as default model of new sessions.
+        self.config["current_model"] = view.value
+        self.save_config()
+        if self.config.get("registry", {}).get("warm_up", False):
+            asyncio.create_task(self.warm_up_model(view.value))
 
     @commands.hybrid_command(name="list", description="List best songs generated in current model.")
     async def _list(self, ctx):
         """List mid and mp3 files in server."""
-        self.load_stats()
-        ranking = {}
-        for key, val in self.song_stats.items():
-            # data[key]["score"] = np.sum([item["vote"] for item in val["rate"]])
-            vote_list = [item["vote"] for item in val["rate"]]
-            score = np.mean(vote_list)
-            ranking[key] = score
-        ranking = sorted(ranking.items(),key=lambda x:x[1], reverse=True)
-
-        embed=discord.Embed(title="model", description=self.current_model)
+        session = self.session(ctx.guild)
+        ranking = self.votes.top_k(session.model, 9)
+
+        embed=discord.Embed(title="model", description=session.model)
         embed.set_author(name="Generated Song Ranking")
 
-        if len(ranking) > 9:
-            ranking = ranking[:9]
         for id, score in ranking:
             embed.add_field(name=id, value=score)
         embed.timestamp = datetime.datetime.now()
@@ -150,19 +185,28 @@ class LofiTransformerPlayer(commands.Cog):
     # TODO: Fix get command in hybird_command
     @commands.hybrid_command(name="get", description="Give id to get .mid and .mp3 files of the song.")
     async def _get(self, ctx, id: str=None):
+        session = self.session(ctx.guild)
+        filedict = self.library.songs(session.out_dir)
         if id is None:
-            if self.lastfile is None:
+            if session.lastfile is None:
                 await ctx.send("No last file.")
                 return
-            songs = self.lastfile
-        elif id not in self.filedict.keys():
-            await ctx.send("Files not found.")
-            return
+            songs = session.lastfile
+        elif id not in filedict.keys():
+            songs = await self.render_evicted(session, id)
+            if songs is None:
+                await ctx.send("Files not found.")
+                return
         else:
-            songs = self.filedict[id]
+            songs = filedict[id]
 
         songs = [discord.File(item) for item in songs]
-        await ctx.send(files=songs)
+        with self.metrics.span("discord_upload", model=session.model):
+            await ctx.send(files=songs)
+
+    @_get.autocomplete("id")
+    async def _get_autocomplete(self, interaction, current):
+        return [app_commands.Choice(name=id, value=id) for id in self.library.prefix_search(self.session(interaction.guild).out_dir, current)]
 
     @commands.hybrid_command(name="play", description="Generate a song!")
     async def _play(self, ctx, id=None):
@@ -171,35 +215,114 @@ class LofiTransformerPlayer(commands.Cog):
         if not state:
             logger.debug("User not in a voice channel, quit play command.")
             return
-        await self.stop_looping()
+        session = self.session(ctx.guild)
+        await self.stop_looping(session)
+        filedict = self.library.songs(session.out_dir)
+        path = None
+        source = None
         if id is None:
-            instrument = self.config["instrument"]
-            current_model_emoji = self.config["model_selection"][self.current_model]["emoji"]
-            hint_msg = await ctx.send(f"Generating...\nmodel: {current_model_emoji} **{self.current_model}**\ninstrument: {get_instrument_emoji(instrument)} **{pretty_midi.program_to_instrument_name(instrument)}**", file=discord.File("img/bocchi.gif"))
-            path = generate(
-                ckpt=self.current_model_ckpt,
-                out=self.out_dir,
-                instrument=int(instrument),
-                display=False
-            )
+            path = self.reservoir.take(session.model, session.instrument)
+            self.metrics.inc("lofi_reservoir_takes_total", model=session.model, hit=path is not None)
+        if path is not None:
+            hint_msg = await ctx.send(f"Play file...")
             mid_path, mp3_path = path
-            await self.update_dict(ctx)
-            self.lastfile = path
-        elif id not in self.filedict.keys():
-            await ctx.send("Files not found.")
-            return
+            self.library.add(mid_path, mp3_path)
+            session.lastfile = path
+        elif id is None:
+            instrument = session.instrument
+            current_model_emoji = self.config["model_selection"][session.model]["emoji"]
+            hint_msg = await ctx.send(f"Generating...\nmodel: {current_model_emoji} **{session.model}**\ninstrument: {get_instrument_emoji(instrument)} **{pretty_midi.program_to_instrument_name(instrument)}**", file=discord.File("img/bocchi.gif"))
+            try:
+                # Includes the wait for a generation slot and the inference queue.
+                with self.metrics.span("generate_request", model=session.model):
+                    async with self.scheduler.slot(session.guild_id):
+                        if self.is_streaming():
+                            mid_path = (await self.inference.generate_mid(
+                                ckpt=session.ckpt,
+                                out=session.out_dir,
+                                model=session.model
+                            ))[0]
+                            path = (mid_path, self.mp3_path_of(mid_path, instrument))
+                            source = StreamingMidiSource(mid_path, instrument, archive_path=path[1], model=session.model)
+                        else:
+                            path = await self.inference.generate(
+                                ckpt=session.ckpt,
+                                out=session.out_dir,
+                                instrument=int(instrument),
+                                model=session.model
+                            )
+            except InferenceQueueFull:
+                await hint_msg.delete()
+                await ctx.send("Too many songs are generating now, please try again later.")
+                return
+            mid_path, mp3_path = path
+            if source is None:
+                self.library.add(mid_path, mp3_path)
+            else:
+                # The mp3 of a streamed song only exists once it is archived. The callback runs
+                # in the render thread, the library is changed on the event loop that iterates it.
+                loop = asyncio.get_running_loop()
+                source.archived.add_done_callback(
+                    lambda f: loop.call_soon_threadsafe(self.library.add, mid_path, mp3_path) if not f.cancelled() and not f.exception() and f.result() else None
+                )
+            session.lastfile = path
+            asyncio.create_task(self.render_other_programs(session, mid_path, instrument))
+            if source is None and self.config.get("opus_cache", {}).get("eager", False):
+                self.cache_opus(mp3_path)
         else:
             hint_msg = await ctx.send(f"Play file...")
-            path = self.filedict[id]
+            path = filedict.get(id)
+            if path is None:
+                path = await self.render_evicted(session, id)
+            if path is None:
+                await hint_msg.delete()
+                await ctx.send("Files not found.")
+                return
             mid_path, mp3_path = path
-            self.lastfile = path
+            session.lastfile = path
         await hint_msg.delete()
-        await self.play_command(ctx, mp3_path)
+        await self.play_command(ctx, mp3_path, source=source)
+
+    async def render_evicted(self, session, id):
+        """Render again a song whose mp3 was evicted by the storage manager, return [mid path, mp3 path] or None."""
+        code, _, instrument = id.partition("_")
+        mid_path = os.path.join(session.out_dir, code+".mid")
+        if not instrument.isdigit() or not os.path.exists(mid_path):
+            return None
+        mp3_path = self.mp3_path_of(mid_path, instrument)
+        try:
+            await self.inference.render(mid_path, session.out_dir, int(instrument), mp3_path, model=session.model)
+        except InferenceQueueFull:
+            return None
+        self.library.add(mid_path, mp3_path)
+        return [mid_path, mp3_path]
+
+    def is_streaming(self):
+        """Whether new songs are played while they are synthesized, instead of after mp3 export."""
+        return self.config.get("playback", {}).get("source", "ffmpeg") == "stream"
+
+    def mp3_path_of(self, mid_path, instrument):
+        code = os.path.basename(mid_path).split(".")[0]
+        return os.path.join(os.path.dirname(mid_path), code+f"_{int(instrument)}.mp3")
+
+    async def render_other_programs(self, session, mid_path, instrument):
+        """Render the other selectable instruments of a new song in background, if `render.eager` is set."""
+        if not self.config.get("render", {}).get("eager", False):
+            return
+        programs = [program for program in midi_program_to_emoji.keys() if program != int(instrument)]
+        try:
+            mp3_paths = await self.inference.render_programs(mid_path, programs, model=session.model)
+        except InferenceQueueFull:
+            logger.debug("Inference queue full, skip eager render.")
+            return
+        for mp3_path in mp3_paths.values():
+            self.library.add(mid_path, mp3_path)
 
     @commands.hybrid_command(name="instrument", description="Dropdown menu to select render instrument.")
     async def _instrument(self, ctx):
         """Show a dropdown selection to set the MIDI render instrument program number."""
-        current_instrument = self.config["instrument"]
+        session = self.session(ctx.guild)
+        current_instrument = session.instrument
         emoji = get_instrument_emoji(current_instrument)
         view = self.get_instrument_dropdown_view(ctx)
         instrument_setting_message = await ctx.send(f"Instrument Setting.\nCurrent instrument is {emoji} **{pretty_midi.program_to_instrument_name(current_instrument)}**", view=view)
@@ -208,9 +331,11 @@ class LofiTransformerPlayer(commands.Cog):
         if view.value == None:
             logger.info("Instrument select view timeout.")
             return
-        self.config["instrument"] = int(view.value)
+        session.instrument = int(view.value)
+        # Remember the choice as default instrument of new sessions.
+        self.config["instrument"] = session.instrument
         self.save_config()
-        current_instrument = self.config["instrument"]
+        current_instrument = session.instrument
         emoji = get_instrument_emoji(current_instrument)
         await instrument_setting_message.edit(content=f"Instrument changed to {emoji} **{pretty_midi.program_to_instrument_name(current_instrument)}**", view=None)
 
@@ -219,35 +344,68 @@ class LofiTransformerPlayer(commands.Cog):
         """Stops and disconnects the bot from voice"""
         await ctx.voice_client.disconnect()
     
-    async def send_rating_view(self, ctx, id, mp3_path, instrument, votable=True):
+    async def send_rating_view(self, ctx, id, mp3_path, instrument, votable=True, time=None):
         # TODO: Should make model as a parameter.
         # TODO: Should be able to reach every needed info from mp3_path
-        current_model_emoji = self.config["model_selection"][self.current_model]["emoji"]
+        session = self.session(ctx.guild)
+        current_model_emoji = self.config["model_selection"][session.model]["emoji"]
         vote_embed=discord.Embed(title=f"Now playing... {get_instrument_emoji(instrument)}", color=0xffc7cd)
         vote_embed.set_thumbnail(url="https://media1.giphy.com/media/mXbQ2IU02cGRhBO2ye/giphy.gif")
         vote_embed.add_field(name="id", value=id, inline=False)
-        vote_embed.add_field(name="time", value=get_audio_time(mp3_path), inline=False)
+        vote_embed.add_field(name="time", value=time or get_audio_time(mp3_path) or "--:--", inline=False)
         vote_embed.add_field(name="instrument", value=f"{get_instrument_emoji(instrument)} {pretty_midi.program_to_instrument_name(instrument)}", inline=False)
-        vote_embed.add_field(name="model", value=f"{current_model_emoji} {self.current_model}", inline=False)
+        vote_embed.add_field(name="model", value=f"{current_model_emoji} {session.model}", inline=False)
         vote_embed.set_footer(text="Please rate the song ⏬")
         vote_embed.timestamp = datetime.datetime.now()
         rating_view = Rating(ctx.author, votable=votable)
         vote_area = await ctx.send(id, embed=vote_embed, view=rating_view)
         return vote_area, vote_embed, rating_view
     
-    async def play_music(self, ctx, mp3_path):
+    async def play_music(self, ctx, mp3_path, source=None):
         if ctx.voice_client.is_playing():
             ctx.voice_client.stop()
-        source = discord.FFmpegPCMAudio(source=mp3_path)
-        ctx.voice_client.play(source, after=lambda e: logger.error(f'Player error: {e}') if e else None)
+        # Keep the storage manager away from the files until playback ends.
+        held = rendered_files(mp3_path)
+        self.holds.hold(*held)
+
+        def after(error):
+            self.holds.release(*held)
+            if error:
+                logger.error(f'Player error: {error}')
+
+        with self.metrics.span("playback_start"):
+            if source is None:
+                source = self.audio_source(mp3_path)
+            ctx.voice_client.play(source, after=after)
+        self.metrics.inc("lofi_songs_played_total", source=type(source).__name__)
     
-    async def play_command(self, ctx, mp3_path, play_music=True, votable=True):
+    def audio_source(self, mp3_path):
+        """Play the cached opus file without transcoding if there is one, otherwise decode mp3 with FFmpeg."""
+        if self.opus_cache is not None:
+            opus_path = self.opus_cache.get(mp3_path)
+            if opus_path is not None:
+                return discord.FFmpegOpusAudio(opus_path, codec="copy")
+            self.cache_opus(mp3_path)
+        return discord.FFmpegPCMAudio(source=mp3_path)
+
+    def cache_opus(self, mp3_path):
+        """Transcode a song into the opus cache in background."""
+        if self.opus_cache is None:
+            return
+        future = asyncio.get_running_loop().run_in_executor(None, self.opus_cache.ensure, mp3_path)
+        future.add_done_callback(lambda f: logger.error(f"Opus cache failed for {mp3_path}.\n{f.exception()}") if f.exception() else None)
+
+    async def play_command(self, ctx, mp3_path, play_music=True, votable=True, source=None, time=None):
+        session = self.session(ctx.guild)
         id = mp3_path.split("/")[-1].split(".")[0]
         code, instrument = id.split("_")
         instrument = int(instrument)
-        vote_area, embed, rating_view = await self.send_rating_view(ctx, id, mp3_path, instrument, votable)
+        if time is None:
+            # NOTE: A streamed song is still being archived to mp3_path.
+            time = format_audio_time(source.duration) if source is not None else get_audio_time(mp3_path)
+        vote_area, embed, rating_view = await self.send_rating_view(ctx, id, mp3_path, instrument, votable, time)
         if play_music:
-            await self.play_music(ctx, mp3_path)
+            await self.play_music(ctx, mp3_path, source)
         await rating_view.wait()
         if rating_view.value == None:
             logger.info("Rating view timeout.")
@@ -256,12 +414,19 @@ class LofiTransformerPlayer(commands.Cog):
         elif rating_view.is_replay:
             await self.ensure_voice(ctx)
             await vote_area.edit(embed=embed, view=None)
+            if not os.path.exists(mp3_path):
+                # Evicted since it was played.
+                path = await self.render_evicted(session, id)
+                if path is None:
+                    await ctx.send("Files not found.")
+                    return
+                mp3_path = path[1]
             await self.play_command(ctx, mp3_path)
         elif rating_view.is_stopped:
             if ctx.voice_client.is_playing():
                 ctx.voice_client.stop()
             await vote_area.delete()
-            await self.play_command(ctx, mp3_path, play_music=False)
+            await self.play_command(ctx, mp3_path, play_music=False, time=time)
         elif rating_view.is_quitted:
             if ctx.voice_client.is_playing():
                 ctx.voice_client.stop()
@@ -282,21 +447,29 @@ class LofiTransformerPlayer(commands.Cog):
             await vote_area.edit(embed=embed, view=None)
             instrument = int(view.value)
             complete_id = code+"_"+str(instrument)
-            if complete_id not in self.filedict.keys():
+            filedict = self.library.songs(session.out_dir)
+            if complete_id not in filedict.keys():
                 hint_msg = await ctx.send(f"Rendering file to {get_instrument_emoji(instrument)}...")
-                path = render_midi_to_mp3(
-                    mid_file_path=self.out_dir+code+".mid",
-                    out_dir=self.out_dir,
-                    instrument=instrument,
-                    mp3_file_path=self.out_dir+code+f"_{instrument}"+".mp3"
-                )
-                mid_path, mp3_path = path
-                await self.update_dict(ctx)
-                self.lastfile = path
+                mid_path = os.path.join(session.out_dir, code+".mid")
+                try:
+                    mp3_path = await self.inference.render(
+                        mid_file_path=mid_path,
+                        out_dir=session.out_dir,
+                        instrument=instrument,
+                        mp3_file_path=os.path.join(session.out_dir, complete_id+".mp3"),
+                        model=session.model
+                    )
+                except InferenceQueueFull:
+                    await hint_msg.delete()
+                    await ctx.send("Too many songs are rendering now, please try again later.")
+                    return
+                path = (mid_path, mp3_path)
+                self.library.add(mid_path, mp3_path)
+                session.lastfile = path
                 id = complete_id
             else:
                 hint_msg = await ctx.send(f"Play file...")
-                song = self.filedict[complete_id]
+                song = filedict[complete_id]
                 mid_path, mp3_path = song
                 id = complete_id
             
@@ -305,25 +478,10 @@ class LofiTransformerPlayer(commands.Cog):
         else:
             if votable:
                 # FIXME: Should create the metadata right after generate but not first time vote.
-                rate = {"user": rating_view.user.name+"#"+rating_view.user.discriminator, "vote": rating_view.value}
-                if id not in self.song_stats.keys():
-                    self.song_stats[id] = {
-                        "code": code,
-                        "time": get_audio_time(mp3_path),
-                        "instrument": instrument,
-                        "model": self.current_model,
-                        "path": mp3_path,
-                        "view": 1,
-                        "rate": [rate],
-                        "score": None
-                    }
-                else:
-                    self.song_stats[id]["view"] += 1
-                    self.song_stats[id]["rate"].append(rate)
-        
-                self.save_stats()
+                user = rating_view.user.name+"#"+rating_view.user.discriminator
+                self.votes.record_vote(session.model, id, mp3_path, time, user, rating_view.value)
             await vote_area.edit(embed=embed, view=None)
-            await self.play_command(ctx, mp3_path, play_music=False, votable=False)
+            await self.play_command(ctx, mp3_path, play_music=False, votable=False, time=time)
     
     @commands.hybrid_command(name="loop", description="Infinitely generate songs and play with current model and instrument setting.")
     async def _loop(self, ctx):
@@ -331,21 +489,23 @@ class LofiTransformerPlayer(commands.Cog):
         if not response:
             logger.debug("Quit loop command")
             return
-        server = ctx.message.guild
-        voice_client = server.voice_client
-        if self.keep_looping and (voice_client.is_playing() or voice_client.is_paused()): # NOTE: If keep_looping and playing, prevent task reinvoke.
-            logger.debug("Already in loop.")
-            return
+        session = self.session(ctx.guild)
+        if session.play_task is not None and not session.play_task.done():
+            if session.keep_looping: # NOTE: Prevent task reinvoke.
+                logger.debug("Already in loop.")
+                return
+            # The stopped loop still cleans up its last song.
+            await session.play_task
         
-        self.keep_looping = True
-        if len(self.queue) == 0:
+        session.keep_looping = True
+        if len(session.queue) == 0:
             await ctx.defer()
-            task = asyncio.create_task(self.generate_song(2))
+            task = asyncio.create_task(self.generate_song(session, 2))
             logger.debug("Waiting first generation task finish.")
             await task
         logger.debug("Started to play loop.")
         await ctx.send("Started to play loop. Call /stop to terminate.")
-        loop_task = asyncio.create_task(self.play_loop(ctx))
+        session.play_task = asyncio.create_task(self.play_loop(ctx))
         await self.generate_song_task(ctx, 3)
     
     @commands.hybrid_command(name="pause", description="Pause the playing audio.")
@@ -374,8 +534,8 @@ class LofiTransformerPlayer(commands.Cog):
 
     @commands.hybrid_command(name="stop", description="Stop the playing audio.")
     async def _stop_media(self, ctx):
-        self.queue = []
-        self.keep_looping = False
+        session = self.session(ctx.guild)
+        await session.stop_loop(clear=True)
         if not ctx.message.author.voice:
             await ctx.send("You are not connected to a voice channel.")
             return
@@ -387,87 +547,156 @@ class LofiTransformerPlayer(commands.Cog):
             voice_channel.stop()
         await ctx.send("Stopped", ephemeral=True)
     
-    async def stop_looping(self):
-        if not self.keep_looping:
+    async def stop_looping(self, session):
+        if not session.keep_looping:
             return
-        self.keep_looping = False
-        logger.debug("Wait 2 sec to stop looping")
-        await asyncio.sleep(2)
-
-    async def generate_song(self, num_songs=5):
-        """Generate the song asynchronously, store path in global queue."""
-        while(len(self.queue) < num_songs and self.keep_looping):
+        await session.stop_loop()
+
+    async def generate_loop_songs(self, session, num_songs):
+        """Generate songs for loop queue of a session in one batch, return [] and back off when inference pool is full."""
+        batch_size = min(num_songs, int(self.config.get("inference", {}).get("max_batch_size", 1)))
+        instrument = session.instrument
+        try:
+            with self.metrics.span("loop_generate_request", model=session.model):
+                async with self.scheduler.slot(session.guild_id):
+                    if self.is_streaming():
+                        mid_paths = await self.inference.generate_mid(
+                            ckpt=session.ckpt,
+                            out=session.loop_dir,
+                            batch_size=max(batch_size, 1),
+                            model=session.model
+                        )
+                        return [(mid_path, self.mp3_path_of(mid_path, instrument)) for mid_path in mid_paths]
+                    return await self.inference.generate_batch(
+                        ckpt=session.ckpt,
+                        out=session.loop_dir,
+                        instrument=instrument,
+                        batch_size=max(batch_size, 1),
+                        model=session.model
+                    )
+        except InferenceQueueFull:
+            logger.debug("Inference queue full, retry later.")
+            await asyncio.sleep(3)
+            return []
+
+    async def generate_song(self, session, num_songs=5):
+        """Generate the song asynchronously, store path in the session queue."""
+        while(len(session.queue) < num_songs and session.keep_looping):
             logger.debug("Generating...")
-            path = generate(
-                ckpt=self.current_model_ckpt,
-                out="./loop_file",
-                instrument=int(self.config["instrument"]),
-                display=False
-            )
+            paths = await self.generate_loop_songs(session, num_songs - len(session.queue))
             logger.debug("Finished!")
-            mid_path, mp3_path = path
-            self.queue.append(path)
+            await session.put_songs(paths)
 
     async def generate_song_task(self, ctx, num_songs=5):
-        while self.keep_looping:
-            while(len(self.queue) >= num_songs):
-                if not self.keep_looping or not ctx.voice_client:
-                    logger.debug("Quit from generate_song_task")
-                    return
-                logger.debug("Queue full now.")
-                await asyncio.sleep(3)
+        """Keep the loop queue of a session filled, waking up only when the player takes a song."""
+        session = self.session(ctx.guild)
+        while await session.wait_for_room(num_songs):
             logger.debug("Generating...")
-            path = generate(
-                ckpt=self.current_model_ckpt,
-                out="./loop_file",
-                instrument=int(self.config["instrument"]),
-                display=False
-            )
+            paths = await self.generate_loop_songs(session, num_songs - len(session.queue))
             logger.debug("Finished!")
-            mid_path, mp3_path = path
-            self.queue.append(path)
+            await session.put_songs(paths)
+        logger.debug("Quit from generate_song_task")
+
+    def loop_source(self, mid_path, mp3_path):
+        """Open the audio source of a loop song, or None if its files are gone."""
+        if os.path.exists(mp3_path):
+            logger.debug(f"Play song: {mp3_path} {get_audio_time(mp3_path)}")
+            return discord.FFmpegPCMAudio(source=mp3_path)
+        if self.is_streaming() and os.path.exists(mid_path):
+            instrument = os.path.basename(mp3_path).split(".")[0].split("_")[1]
+            source = StreamingMidiSource(mid_path, instrument)
+            logger.debug(f"Stream song: {mid_path} {format_audio_time(source.duration)}")
+            return source
+        return None
+
+    async def open_next_loop_song(self, session):
+        """Wait for the next loop song and open its source, return None once the loop is stopped."""
+        while True:
+            path = await session.next_song()
+            if path is None:
+                return None
+            source = self.loop_source(*path)
+            if source is not None:
+                return path, source
+            logger.debug("mp3 file not exist, play next.")
+
+    def remove_loop_files(self, mid_path, mp3_path):
+        if not os.path.exists(mp3_path):
+            logger.warning(f"{mp3_path} not exist.")
+        for path in [mid_path] + rendered_files(mp3_path):
+            if os.path.exists(path) and not self.holds.held(path):
+                os.remove(path)
 
     async def play_loop(self, ctx):
+        """Play the loop queue of a session until it is stopped.
+
+        The next song is opened while the current one plays and started as soon as
+        the `after` callback of the voice client fires, so there is no gap between
+        songs. Files of a song are removed once it has finished playing.
+        """
+        session = self.session(ctx.guild)
         if not ctx.message.author.voice:
             await ctx.send("You are not connected to a voice channel.")
-        elif len(self.queue) == 0:
+            return
+        elif len(session.queue) == 0:
             await ctx.send("Playing queue is empty.")
-        else:
-            await self.ensure_voice(ctx)
-            voice_client = ctx.message.guild.voice_client
-            while self.queue and self.keep_looping:
-                try:
-                    while voice_client.is_playing() or voice_client.is_paused():
-                        logger.debug(f"Hi in loop. {self.queue}")
-                        await asyncio.sleep(3)
-                except AttributeError:
-                    logger.error("Attribute error.")
-                try:
-                    mid_path, mp3_path = self.queue[0]
-                    if not os.path.exists(mp3_path):
-                        logger.debug("mp3 file not exist, delete and play next.")
-                        del(self.queue[0])
-                        continue
-                    logger.debug(f"Play song: {mp3_path} {get_audio_time(mp3_path)}")
-                    source = discord.FFmpegPCMAudio(source=mp3_path)
-                    if ctx.voice_client == None:
-                        logger.warning(f"{Fore.YELLOW}voice_client == None{Fore.RESET}")
-                        break
-                    ctx.voice_client.play(source, after=lambda e: logger.error(f'Player error: {e}') if e else None)
-                    await asyncio.sleep(2)
-                    if os.path.exists(mid_path):
-                        os.remove(mid_path)
-                    else:
-                        logger.warning("mid file not exist.")
-                    if os.path.exists(mp3_path):
-                        os.remove(mp3_path)
-                    else:
-                        logger.warning("mp3 file not exist.")
-                    del(self.queue[0])
-                except Exception as e:
-                    logger.error(f"{Fore.RED}Got error in play section.{Fore.RESET}\n{e}")
+            return
+        await self.ensure_voice(ctx)
+        loop = asyncio.get_running_loop()
+        clears = session.clears
+        upcoming, prefetch = None, None
+        try:
+            while session.keep_looping:
+                if upcoming is None:
+                    upcoming = await self.open_next_loop_song(session)
+                    continue
+                if ctx.voice_client == None:
+                    logger.warning(f"{Fore.YELLOW}voice_client == None{Fore.RESET}")
                     break
+                (mid_path, mp3_path), source = upcoming
+                upcoming = None
+                finished = asyncio.Event()
+
+                def after(error):
+                    if error:
+                        logger.error(f'Player error: {error}')
+                    loop.call_soon_threadsafe(finished.set)
 
+                held = rendered_files(mp3_path)
+                self.holds.hold(*held)
+                try:
+                    try:
+                        ctx.voice_client.play(source, after=after)
+                    except Exception:
+                        # The voice client never took the source, e.g. it was disconnected.
+                        source.cleanup()
+                        raise
+                    prefetch = asyncio.create_task(self.open_next_loop_song(session))
+                    await finished.wait()
+                finally:
+                    self.holds.release(*held)
+                    self.remove_loop_files(mid_path, mp3_path)
+                upcoming = await prefetch
+                prefetch = None
+        except Exception as e:
+            logger.error(f"{Fore.RED}Got error in play section.{Fore.RESET}\n{e}")
+        finally:
+            if prefetch is not None:
+                # Stopped while the next song was being opened.
+                if not prefetch.done():
+                    prefetch.cancel()
+                elif not prefetch.cancelled() and prefetch.exception() is None:
+                    upcoming = prefetch.result()
+            if upcoming is not None:
+                path, source = upcoming
+                source.cleanup()
+                if session.clears == clears:
+                    # Keep the opened song for the next loop.
+                    session.queue.insert(0, path)
+                else:
+                    # The queue was cleared by /stop, drop the song with it.
+                    self.remove_loop_files(*path)
+            await session.stop_loop()
 
     def get_instrument_dropdown_view(self, ctx):
         return InstrumentSelectDropdownView(ctx.author)
@@ -483,11 +712,6 @@ class LofiTransformerPlayer(commands.Cog):
         elif ctx.voice_client.is_playing():
             ctx.voice_client.stop()
         return True
-    
-    @_list.before_invoke
-    @_get.before_invoke
-    async def update_dict(self, ctx):
-        self.filedict = getfiles(self.out_dir)
 
 async def setup(client):
     await client.add_cog(LofiTransformerPlayer(client))
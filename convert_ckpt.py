@@ -0,0 +1,54 @@
+import os
+import json
+import time
+import argparse
+from collections import OrderedDict
+
+import torch
+
+from bot_utils.model_registry import load_state_dict, mapped_path, has_mapped, load_mapped_state_dict
+
+CONFIG_PATH = "./config/config.json"
+
+
+def convert_checkpoint(ckpt_path, force=False):
+    """Write the fast-loading copy of a checkpoint next to it, return its path.
+
+    Keys are normalized once and every tensor is saved contiguous on CPU, so
+    the loader maps the file with `torch.load(mmap=True)` instead of unpickling
+    and copying the weights.
+    """
+    out_path = mapped_path(ckpt_path)
+    if not force and has_mapped(ckpt_path):
+        print(f"{out_path} is up to date.")
+        return out_path
+    start = time.perf_counter()
+    state_dict = OrderedDict((k, v.detach().cpu().contiguous()) for k, v in load_state_dict(ckpt_path).items())
+    temp_path = f"{out_path}.{os.getpid()}.part"
+    try:
+        torch.save(state_dict, temp_path)
+        os.replace(temp_path, out_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    mapped = load_mapped_state_dict(ckpt_path)
+    if mapped.keys() != state_dict.keys() or any(not torch.equal(mapped[k], v) for k, v in state_dict.items()):
+        os.remove(out_path)
+        raise RuntimeError(f"{out_path} doesn't match {ckpt_path}, removed.")
+    size = os.path.getsize(out_path) / 1024 / 1024
+    print(f"{ckpt_path} -> {out_path} ({len(state_dict)} tensors, {size:.1f}MB) in {time.perf_counter() - start:.2f}s.")
+    return out_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the checkpoints of the config to the memory-mapped format loaded by the bot.")
+    parser.add_argument('-c', '--config', help='Config file with the model selection.', type=str, default=CONFIG_PATH)
+    parser.add_argument('-m', '--models', help='Models to convert, all of the model selection by default.', nargs='+', default=None)
+    parser.add_argument('-f', '--force', help='Convert again even if the converted file is up to date.', action='store_true')
+    args = parser.parse_args()
+
+    config = json.load(open(args.config))
+    models = args.models or list(config["model_selection"])
+    for model in models:
+        convert_checkpoint(config["model_selection"][model]["ckpt_path"], force=args.force)
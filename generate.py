@@ -1,77 +1,122 @@
 import os
 import argparse
-import pickle
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 import miditoolkit
 import numpy as np
-from midi2audio import FluidSynth
 
-import torch
-import torch.multiprocessing as mp
+from utils import get_random_string
+from bot_utils.model_registry import get_registry, set_num_threads
+from bot_utils.decoding import decode_songs, check_parity
+from bot_utils.constrained_decoding import decode_constrained
+from bot_utils.midi_decoder import words_to_midi
+from bot_utils.renderer import get_renderer
+from bot_utils.mastering import get_mastering_settings, master
+from bot_utils.encoder_pool import get_encoder_pool, with_mp3
+from bot_utils.song_metadata import write_song_metadata
+from bot_utils.metrics import get_metrics
 
-from collections import OrderedDict
-from pydub import AudioSegment
+# Budget settings of the constrained decoder that a `model_selection` entry may set.
+CONSTRAINED_OPTIONS = ("max_tokens", "max_bars", "min_bars", "max_bar_tokens", "max_resumes")
 
-import saver
-from models import TransformerModel, network_paras
-from utils import make_midi, get_random_string
+_midi_writer = None
 
-DATASET_PATH = "./lofi_dataset"
+def dump_midi_async(midi_obj, mid_file_path, model=None):
+    """Write a midi file in the background writer thread, return its future."""
+    global _midi_writer
+    if _midi_writer is None:
+        _midi_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="midi_dump")
 
-def generate_mid(ckpt_path, out_dir="gen", verbose=True):
-    """Inference one song and output the midi file using random name."""
+    def dump():
+        with get_metrics().span("midi_dump", model=model):
+            midi_obj.dump(mid_file_path)
+        return mid_file_path
+    return _midi_writer.submit(dump)
+
+def generate_mid(ckpt_path, out_dir="gen", verbose=True, model=None, batch_size=1):
+    """Inference songs and output the midi files using random names.
+
+    With `batch_size` > 1, a list of midi file paths is returned instead of a
+    single path, see `generate_midi_objs`.
+    """
+    songs = generate_midi_objs(ckpt_path, out_dir, verbose, model, batch_size)
+    mid_file_paths = [future.result() for _, _, future in songs]
+    if batch_size == 1:
+        return mid_file_paths[0]
+    return mid_file_paths
+
+def generate_midi_objs(ckpt_path, out_dir="gen", verbose=True, model=None, batch_size=1):
+    """Inference `batch_size` songs, return (midi file path, midi object, dump future) of each one.
+
+    The model and dictionary are taken from the process-wide model registry, so
+    only the first song of a model pays for loading the checkpoint. With
+    `batch_size` > 1, the songs are decoded together in one batch.
+
+    The midi files are written in the background, so the midi objects can be
+    rendered right away. Wait for the futures before using the files.
+
+    The "constrained" decoder never decodes a song again, its budget is read
+    from the `CONSTRAINED_OPTIONS` of the model entry.
+    """
     os.makedirs(out_dir, exist_ok=True)
 
-    dictionary = pickle.load(open(os.path.join(DATASET_PATH, "dictionary.pkl"), 'rb'))
+    metrics = get_metrics()
+    registry = get_registry()
+    dictionary = registry.dictionary
     event2word, word2event = dictionary
+    n_token = len(event2word.keys())
+
+    if model is None:
+        model = registry.name_for_ckpt(ckpt_path)
+    net = registry.get(model)
+    setting = registry.setting(model)
+    decoder = setting.get("decoder", "reference")
+    if registry.device(model) == "cpu" and decoder == "reference":
+        # NOTE: inference_from_scratch hard-codes cuda tensors.
+        decoder = "recurrent"
+
+    with metrics.span("decode", model=model) as span:
+        if batch_size == 1 and decoder == "reference":
+            res = None
+            attempts = 0
+            while not isinstance(res, np.ndarray):
+                if attempts > 0:
+                    metrics.inc("lofi_decode_retries_total", model=model)
+                attempts += 1
+                if n_token == 8:
+                    res, _ = net.inference_from_scratch(dictionary, 0, n_token, display=verbose)
+            songs = [res]
+        elif decoder == "constrained":
+            options = {key: setting[key] for key in CONSTRAINED_OPTIONS if key in setting}
+            songs = decode_constrained(net, dictionary, batch_size, verbose=verbose, model=model, **options)
+        else:
+            songs = decode_songs(net, dictionary, batch_size, verbose=verbose, model=model)
+    if metrics.enabled:
+        tokens = sum(len(res) for res in songs)
+        metrics.inc("lofi_decoded_tokens_total", tokens, model=model)
+        metrics.set("lofi_decode_tokens_per_second", tokens / max(span.seconds, 1e-9), model=model)
+        metrics.inc("lofi_songs_generated_total", len(songs), model=model)
 
-    # config
-    n_class = []   # num of classes for each token
-    for key in event2word.keys():
-        n_class.append(len(event2word[key]))
-    n_token = len(n_class)
-
-    # init model
-    net = TransformerModel(n_class, is_training=False)
-    net.cuda()
-    net.eval()
-
-    # load weight
-    try:
-        net.load_state_dict(torch.load(ckpt_path))
-    except:
-        state_dict = torch.load(ckpt_path)
-        new_state_dict = OrderedDict()
-        for k, v in state_dict.items():
-            name = k[7:] 
-            new_state_dict[name] = v
-        net.load_state_dict(new_state_dict)
-
-    res = None
-    while not isinstance(res, np.ndarray):
-        if n_token == 8:
-            res, _ = net.inference_from_scratch(dictionary, 0, n_token, display=verbose)
-
-    filename = get_random_string(length=10)
-    mid_file_path = os.path.join(out_dir, filename+".mid")
-    # Get midi object.
-    midi_obj = make_midi(res, word2event)
-
-    # Only take first tempo change.
-    # midi_obj.tempo_changes = midi_obj.tempo_changes[:2]
-
-    # output midi.
-    midi_obj.dump(mid_file_path)
-
-    return mid_file_path
-
-def render_midi_to_mp3(mid_file_path, out_dir=".", instrument=0, mp3_file_path="./out.mp3", soundfont="./soundfonts/A320U.sf2"):
+    midi_songs = []
+    for res in songs:
+        filename = get_random_string(length=10)
+        mid_file_path = os.path.join(out_dir, filename+".mid")
+        # Get midi object.
+        with metrics.span("make_midi", model=model):
+            midi_obj = words_to_midi(res, word2event)
+
+        # Only take first tempo change.
+        # midi_obj.tempo_changes = midi_obj.tempo_changes[:2]
+
+        midi_songs.append((mid_file_path, midi_obj, dump_midi_async(midi_obj, mid_file_path, model)))
+    return midi_songs
+
+def render_midi_to_mp3(mid_file_path, out_dir=".", instrument=0, mp3_file_path="./out.mp3", soundfont="./soundfonts/A320U.sf2", model=None):
     """render midi to mp3 with specified instrument and soundfont.
     
     Parameters
     ----------
-    midi_obj : miditoolkit.midi.parser.MidiFile
-        The source midi obj.
+    mid_file_path : str
+        The source midi file, it is not modified.
     out_dir : str
         The audio output path.
     instrument : int
@@ -80,66 +125,136 @@ def render_midi_to_mp3(mid_file_path, out_dir=".", instrument=0, mp3_file_path="
         The output audio file name.
     soundfont : str
         Soundfont file path for FluidSynth to render.
+    model : str
+        Model name recorded in the song metadata sidecar.
     
     Return
     ------
-    str, str
-        Return midi file path and mp3 file path.
+    str
+        Return mp3 file path.
     """
-    midi_synth = FluidSynth(sound_font=soundfont)
-
-    temp_file_name = f"/tmp/{get_random_string(length=10)}"
-    wav_file_path = temp_file_name+".wav" 
-    
-    # NOTE: Duplicate code, refer to make_midi() in utils
     midi_obj = miditoolkit.midi.parser.MidiFile(mid_file_path)
-    midi_obj.instruments[0].program = instrument
-    midi_obj.dump(mid_file_path)
+    return render_midi_obj_to_mp3(midi_obj, instrument, mp3_file_path, soundfont, model)
 
-    midi_synth.midi_to_audio(mid_file_path, wav_file_path)
+def render_midi_obj_async(midi_obj, instrument, mp3_file_path, soundfont="./soundfonts/A320U.sf2", model=None):
+    """Render and master a midi object, then hand the PCM to the encoder pool.
 
-    # convert to mp3
-    wav = AudioSegment.from_wav(wav_file_path)
-    wav += 20
-    wav.export(mp3_file_path, format="mp3")
-    print(f"{mp3_file_path} exported!")
+    Return the future of the encode job, the song metadata is written once the
+    mp3 and the other configured outputs are. The midi object is not modified.
+    """
+    metrics = get_metrics()
+    renderer = get_renderer(soundfont)
+    with metrics.span("synth", model=model):
+        pcm = renderer.render(midi_obj, program=instrument)
+    with metrics.span("mastering", model=model):
+        pcm = master(pcm, renderer.sample_rate, get_mastering_settings())
+
+    def exported(report):
+        print(f"{mp3_file_path} exported!")
+        write_song_metadata(mp3_file_path, report["audio_seconds"], renderer.sample_rate, midi_obj, model, instrument)
 
-    os.remove(wav_file_path)
+    pool = get_encoder_pool()
+    return pool.submit(pcm, renderer.sample_rate, mp3_file_path, with_mp3(pool.outputs), model=model, done=exported)
 
+def render_midi_obj_to_mp3(midi_obj, instrument, mp3_file_path, soundfont="./soundfonts/A320U.sf2", model=None):
+    """Render a parsed midi object with the instrument program, the midi object is not modified."""
+    render_midi_obj_async(midi_obj, instrument, mp3_file_path, soundfont, model).result()
     return mp3_file_path
 
-def generate(ckpt, out, instrument, display=True):
+_program_renderers = None
+
+def render_programs(mid_file_path, programs, out_dir=None, soundfont="./soundfonts/A320U.sf2", model=None):
+    """Render a midi file with several instrument programs in parallel.
+
+    The midi file is parsed once and never rewritten. Each program is rendered in
+    a thread of a long-lived pool, whose threads keep their synthesizer and
+    soundfont loaded between calls. FluidSynth and the mp3 encoder run outside
+    the GIL so the renders spread over the cores.
+
+    Parameters
+    ----------
+    mid_file_path : str
+        The source midi file.
+    programs : list of int
+        MIDI instrument program numbers to render.
+    out_dir : str
+        The audio output folder, default is the folder of the midi file.
+
+    Return
+    ------
+    dict
+        MIDI program number to the `<code>_<program>.mp3` path.
+    """
+    programs = [int(program) for program in programs]
+    if not programs:
+        return {}
+    if out_dir is None:
+        out_dir = os.path.dirname(mid_file_path)
+    song_id = os.path.basename(mid_file_path).split(".")[0]
+    midi_obj = miditoolkit.midi.parser.MidiFile(mid_file_path)
+
+    def render(program):
+        mp3_file_path = os.path.join(out_dir, song_id+f"_{program}.mp3")
+        return program, render_midi_obj_to_mp3(midi_obj, program, mp3_file_path, soundfont, model)
+
+    global _program_renderers
+    if _program_renderers is None:
+        _program_renderers = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="program_render")
+    return dict(_program_renderers.map(render, programs))
+
+def generate(ckpt, out, instrument, display=True, model=None):
     """Inference a song and return its mid and mp3 path"""
-    mid_file_path = generate_mid(
+    return generate_batch(ckpt, out, instrument, batch_size=1, display=display, model=model)[0]
+
+def generate_batch(ckpt, out, instrument, batch_size, display=True, model=None):
+    """Inference `batch_size` songs in one batch and return a list of their mid and mp3 path"""
+    songs = generate_midi_objs(
         ckpt_path=ckpt,
         out_dir=out,
-        verbose=display
+        verbose=display,
+        model=model,
+        batch_size=batch_size
     )
-    song_id = os.path.basename(mid_file_path).split(".")[0]
-    mp3_file_path = os.path.join(os.path.dirname(mid_file_path), song_id+f"_{instrument}.mp3")
-    render_midi_to_mp3(
-        mid_file_path=mid_file_path,
-        out_dir=out,
-        mp3_file_path=mp3_file_path,
-        instrument=instrument,
-    )
-    return mid_file_path, mp3_file_path
+    paths, encodes = [], []
+    for mid_file_path, midi_obj, future in songs:
+        song_id = os.path.basename(mid_file_path).split(".")[0]
+        mp3_file_path = os.path.join(os.path.dirname(mid_file_path), song_id+f"_{instrument}.mp3")
+        # Render the decoded midi object while its file is written, and the next song while this one is encoded.
+        encodes.append(render_midi_obj_async(midi_obj, instrument, mp3_file_path, model=model))
+        paths.append((future.result(), mp3_file_path))
+    for encode in encodes:
+        encode.result()
+    return paths
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--ckpt', help='The checkpoint path that model should load.', type=str)
     parser.add_argument('-o', '--out', help='The folder that save the generated song.', type=str)
     parser.add_argument('-i', '--instrument', help='The instrument program number to render generated song.', type=int)
+    parser.add_argument('-n', '--batch-size', help='The number of songs to generate in one batch.', type=int, default=1)
+    parser.add_argument('--decoder', help='Decoding engine, "reference" uses inference_from_scratch, "recurrent" steps the encoder memory directly, "constrained" also masks illegal words and bounds the song length.', type=str, default="reference", choices=["reference", "recurrent", "constrained"])
+    parser.add_argument('--max-tokens', help='Word budget of a song with the constrained decoder.', type=int, default=None)
+    parser.add_argument('--max-bars', help='Bar budget of a song with the constrained decoder.', type=int, default=None)
+    parser.add_argument('--device', help='Device to run the model on, e.g. "cuda" or "cpu".', type=str, default="cuda")
+    parser.add_argument('--quantize', help='Apply dynamic int8 quantization to linear layers, runs on CPU.', action='store_true')
+    parser.add_argument('--threads', help='Number of intra-op threads for CPU inference.', type=int, default=None)
+    parser.add_argument('--parity', help='Check that the recurrent decoder gives the same distributions as the model, then exit.', action='store_true')
     args = parser.parse_args()
 
-    mid_file_path = generate_mid(
-        ckpt_path=args.ckpt,
-        out_dir=args.out,
-        verbose=False
-    )
-    mp3_file_path = render_midi_to_mp3(
-        mid_file_path,
-        out_dir=args.out,
+    set_num_threads(args.threads)
+    registry = get_registry()
+    budget = {key: value for key, value in (("max_tokens", args.max_tokens), ("max_bars", args.max_bars)) if value is not None}
+    registry.register(args.ckpt, args.ckpt, decoder=args.decoder, device=args.device, quantize=args.quantize, **budget)
+    if args.parity:
+        print(check_parity(registry.get(args.ckpt), registry.dictionary))
+        exit()
+
+    paths = generate_batch(
+        ckpt=args.ckpt,
+        out=args.out,
         instrument=args.instrument,
+        batch_size=args.batch_size,
+        display=False
     )
-    print(mid_file_path, mp3_file_path)
+    for mid_file_path, mp3_file_path in paths:
+        print(mid_file_path, mp3_file_path)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The repo is not a package, tests import its modules from the root like the bot does.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,298 @@
+"""Parity of the batched recurrent decoder with a one-song reference decoder.
+
+Most cases run on CPU with `StubTransformerModel`, which has the layers
+`bot_utils.decoding` reads from EMOPIA's `TransformerModel`. Its
+`inference_from_scratch` has the sampling loop of EMOPIA's, but its
+`forward_hidden` encodes the whole prefix again at every step instead of feeding
+the recurrent memory, so the (S, Z) state `transformer_encoder` keeps between
+words is checked against causal linear attention computed from scratch.
+
+`test_same_song_as_emopia` drives the real `TransformerModel.inference_from_scratch`
+of a tiny random model, it needs EMOPIA's `models`, fast-transformers and CUDA.
+"""
+import sys
+import types
+
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from bot_utils.decoding import SAMPLERS, TYPE, decode_batch, forward_step, project, sample
+
+N_CLASS = [8, 6, 5, 4, 10, 6, 5, 5]
+D_MODEL = 16
+ATOL = 1e-5
+
+
+def softmax_with_temperature(logits, temperature):
+    probs = np.exp(logits / temperature) / np.sum(np.exp(logits / temperature))
+    return probs
+
+
+def weighted_sampling(probs):
+    probs /= sum(probs)
+    sorted_probs = np.sort(probs)[::-1]
+    sorted_index = np.argsort(probs)[::-1]
+    return np.random.choice(sorted_index, size=1, p=sorted_probs)[0]
+
+
+def nucleus(probs, p):
+    probs /= (sum(probs) + 1e-5)
+    sorted_probs = np.sort(probs)[::-1]
+    sorted_index = np.argsort(probs)[::-1]
+    after_threshold = np.cumsum(sorted_probs) > p
+    if sum(after_threshold) > 0:
+        last_index = np.where(after_threshold)[0][0] + 1
+        candi_index = sorted_index[:last_index]
+    else:
+        candi_index = sorted_index[:]
+    candi_probs = np.array([probs[i] for i in candi_index])
+    candi_probs /= sum(candi_probs)
+    return np.random.choice(candi_index, size=1, p=candi_probs)[0]
+
+
+def sampling(logit, p=None, t=1.0, is_training=False):
+    """`models.sampling` of EMOPIA."""
+    logit = logit.squeeze().cpu().numpy()
+    probs = softmax_with_temperature(logits=logit, temperature=t)
+    if p is not None:
+        return nucleus(probs, p=p)
+    return weighted_sampling(probs)
+
+
+def causal_linear_attention(q, k, v):
+    """Output of the last position of (length, d) queries, keys and values."""
+    q, k = nn.functional.elu(q) + 1, nn.functional.elu(k) + 1
+    state = k.t() @ v
+    return (q[-1] @ state) / (q[-1] @ k.sum(0))
+
+
+class RecurrentEncoder(nn.Module):
+    """One layer of causal linear attention fed one word at a time, memory is the (S, Z) state."""
+
+    def __init__(self, d_model):
+        super().__init__()
+        self.query = nn.Linear(d_model, d_model)
+        self.key = nn.Linear(d_model, d_model)
+        self.value = nn.Linear(d_model, d_model)
+        self.out = nn.Linear(d_model, d_model)
+
+    def forward(self, x, memory=None):
+        q = nn.functional.elu(self.query(x)) + 1
+        k = nn.functional.elu(self.key(x)) + 1
+        v = self.value(x)
+        if memory is None:
+            memory = (torch.zeros(x.shape[0], x.shape[1], x.shape[1]), torch.zeros(x.shape[0], x.shape[1]))
+        s, z = memory
+        s = s + k.unsqueeze(-1) * v.unsqueeze(1)
+        z = z + k
+        attention = torch.einsum("bd,bde->be", q, s) / (q * z).sum(-1, keepdim=True)
+        return x + self.out(attention), (s, z)
+
+    def full(self, x):
+        """Encode a whole (length, d_model) prefix again, return the hidden of its last word."""
+        attention = causal_linear_attention(self.query(x), self.key(x), self.value(x))
+        return (x[-1] + self.out(attention)).unsqueeze(0)
+
+
+class PositionalEncoding(nn.Module):
+    def __init__(self, d_model):
+        super().__init__()
+        self.register_buffer("pe", torch.randn(1, 1, d_model))
+
+    def forward(self, x):
+        return x + self.pe[:, :x.size(1)]
+
+
+class StubTransformerModel(nn.Module):
+    def __init__(self, dictionary):
+        super().__init__()
+        self.dictionary = dictionary
+        names = ["tempo", "chord", "barbeat", "type", "pitch", "duration", "velocity", "emotion"]
+        for name, n in zip(names, N_CLASS):
+            setattr(self, f"word_emb_{name}", nn.Embedding(n, 4))
+        self.in_linear = nn.Linear(4 * 8, D_MODEL)
+        self.pos_emb = PositionalEncoding(D_MODEL)
+        self.transformer_encoder = RecurrentEncoder(D_MODEL)
+        self.project_concat_type = nn.Linear(D_MODEL + 4, D_MODEL)
+        for name, n in zip(names[:-1], N_CLASS[:-1]):
+            setattr(self, f"proj_{name}", nn.Linear(D_MODEL, n))
+        with torch.no_grad():
+            # Songs of a few dozen words: EOS is likely enough, Emotion never sampled.
+            self.proj_type.weight.mul_(0.1)
+            self.proj_type.bias.copy_(torch.tensor([1.0, -20.0, 1.0, 2.5]))
+
+    def forward_hidden(self, x, memory=None, is_training=False):
+        """Embed the newest word, encode the whole prefix kept in `memory` again.
+
+        EMOPIA's `forward_hidden` feeds the recurrent encoder its memory instead,
+        this stub recomputes the attention so the decoder's state is checked.
+        """
+        embs = torch.cat([
+            getattr(self, f"word_emb_{name}")(x[..., i])
+            for i, name in enumerate(["tempo", "chord", "barbeat", "type", "pitch", "duration", "velocity", "emotion"])
+        ], dim=-1)
+        emb = self.pos_emb(self.in_linear(embs)).squeeze(0)
+        memory = emb if memory is None else torch.cat([memory, emb])
+        h = self.transformer_encoder.full(memory)
+        return h, self.proj_type(h), memory
+
+    def froward_output_sampling(self, h, y_type):
+        cur_word_type = sampling(y_type[0, :], p=0.90)
+        type_word_t = torch.from_numpy(np.array([cur_word_type])).long().unsqueeze(0)
+        tf_skip_type = self.word_emb_type(type_word_t).squeeze(0)
+        y_ = self.project_concat_type(torch.cat([h, tf_skip_type], dim=-1))
+        cur_word_tempo = sampling(self.proj_tempo(y_), t=1.2, p=0.9)
+        cur_word_barbeat = sampling(self.proj_barbeat(y_), t=1.2)
+        cur_word_chord = sampling(self.proj_chord(y_), p=0.99)
+        cur_word_pitch = sampling(self.proj_pitch(y_), p=0.9)
+        cur_word_duration = sampling(self.proj_duration(y_), t=2, p=0.9)
+        cur_word_velocity = sampling(self.proj_velocity(y_), t=5)
+        next_arr = np.array([
+            cur_word_tempo, cur_word_chord, cur_word_barbeat, cur_word_type,
+            cur_word_pitch, cur_word_duration, cur_word_velocity, 0,
+        ])
+        return next_arr, None
+
+    def inference_from_scratch(self, dictionary, emotion_tag, n_token=8, display=False):
+        """Same loop as EMOPIA's on CPU, with the prefix re-encoding `forward_hidden`."""
+        event2word, word2event = dictionary
+        init = np.array([
+            [0, 0, 0, 1, 0, 0, 0, emotion_tag],
+            [0, 0, 1, 2, 0, 0, 0, 0],
+        ])
+        with torch.no_grad():
+            final_res = []
+            memory = None
+            init_t = torch.from_numpy(init).long()
+            for step in range(init.shape[0]):
+                final_res.append(init[step, :][None, ...])
+                h, y_type, memory = self.forward_hidden(init_t[step, :].unsqueeze(0).unsqueeze(0), memory)
+            while True:
+                next_arr, y_emotion = self.froward_output_sampling(h, y_type)
+                final_res.append(next_arr[None, ...])
+                h, y_type, memory = self.forward_hidden(torch.from_numpy(next_arr).long().unsqueeze(0).unsqueeze(0), memory)
+                if word2event['type'][next_arr[3]] == 'EOS':
+                    break
+                if len(final_res) > 512:
+                    return None, None
+        return np.concatenate(final_res), y_emotion
+
+
+def stub_dictionary():
+    word2event = {
+        key: {i: f"{key}_{i}" for i in range(n)}
+        for key, n in zip(["tempo", "chord", "bar-beat", "type", "pitch", "duration", "velocity", "emotion"], N_CLASS)
+    }
+    word2event["type"] = {0: "EOS", 1: "Emotion", 2: "Metrical", 3: "Note"}
+    event2word = {key: {event: i for i, event in events.items()} for key, events in word2event.items()}
+    return event2word, word2event
+
+
+@pytest.fixture
+def net(monkeypatch):
+    # `sample_numpy` imports `sampling` from EMOPIA's models module.
+    monkeypatch.setitem(sys.modules, "models", types.SimpleNamespace(sampling=sampling))
+    torch.manual_seed(0)
+    return StubTransformerModel(stub_dictionary()).eval()
+
+
+@pytest.fixture
+def emopia_net(monkeypatch):
+    """A tiny randomly initialized `TransformerModel` of EMOPIA, biased to end its songs like the stub."""
+    pytest.importorskip("fast_transformers")
+    models = pytest.importorskip("models")
+    if not torch.cuda.is_available():
+        pytest.skip("EMOPIA's inference_from_scratch only runs on CUDA.")
+    # NOTE: TransformerModel reads its dimensions from module globals.
+    monkeypatch.setattr(models, "D_MODEL", D_MODEL)
+    monkeypatch.setattr(models, "N_LAYER", 2)
+    monkeypatch.setattr(models, "N_HEAD", 2)
+    torch.manual_seed(0)
+    net = models.TransformerModel(N_CLASS, is_training=False)
+    with torch.no_grad():
+        net.proj_type.weight.mul_(0.1)
+        net.proj_type.bias.copy_(torch.tensor([1.0, -20.0, 1.0, 2.5]))
+    return net.cuda().eval()
+
+
+def decode_reference(net, seed):
+    np.random.seed(seed)
+    res = None
+    while not isinstance(res, np.ndarray):
+        res, _ = net.inference_from_scratch(net.dictionary, 0, 8)
+    return res
+
+
+def decode_recurrent(net, seed):
+    np.random.seed(seed)
+    res = None
+    while not isinstance(res, np.ndarray):
+        res = decode_batch(net, net.dictionary, 1, max_tokens=513, sampler="numpy")[0]
+    return res
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_song_for_same_seed(net, seed):
+    reference = decode_reference(net, seed)
+    res = decode_recurrent(net, seed)
+    assert reference[-1, TYPE] == 0
+    np.testing.assert_array_equal(res, reference)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_logits(net, seed):
+    words = torch.from_numpy(decode_reference(net, seed)).long()
+    ref_memory, memory = None, None
+    with torch.no_grad():
+        for step in range(len(words) - 1):
+            ref_h, ref_y_type, ref_memory = net.forward_hidden(words[step].view(1, 1, -1), ref_memory)
+            h, y_type, memory = forward_step(net, words[step].unsqueeze(0), memory)
+            torch.testing.assert_close(y_type, ref_y_type, atol=ATOL, rtol=0)
+            type_words = words[step + 1, TYPE].view(1)
+            ref_logits = project(net, ref_h, type_words)
+            for field, logits in project(net, h, type_words).items():
+                torch.testing.assert_close(logits, ref_logits[field], atol=ATOL, rtol=0)
+
+
+def test_finished_songs_leave_the_batch(net, monkeypatch):
+    """Every song of a batch is sampled from its own logits while finished songs leave the batch."""
+    calls = []
+
+    def recording_sample(logits, t=1.0, p=None, generator=None):
+        calls.append(logits.clone())
+        return sample(logits, t, p, generator)
+    monkeypatch.setitem(SAMPLERS, "torch", recording_sample)
+    torch.manual_seed(0)
+    songs = decode_batch(net, net.dictionary, 8, max_tokens=513)
+    assert len({len(song) for song in songs}) > 1
+
+    # The type is sampled first, then the 6 other fields.
+    type_logits = calls[::7]
+    with torch.no_grad():
+        for index, song in enumerate(songs):
+            words = torch.from_numpy(song).long()
+            memory = None
+            for step in range(len(words) - 1):
+                _, ref_y_type, memory = net.forward_hidden(words[step].view(1, 1, -1), memory)
+                if step < 1:
+                    continue
+                active = [i for i, other in enumerate(songs) if len(other) > step + 1]
+                row = type_logits[step - 1][active.index(index)]
+                torch.testing.assert_close(row, ref_y_type[0], atol=ATOL, rtol=0)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_same_song_as_emopia(emopia_net, seed):
+    dictionary = stub_dictionary()
+    np.random.seed(seed)
+    reference = None
+    while not isinstance(reference, np.ndarray):
+        reference, _ = emopia_net.inference_from_scratch(dictionary, 0, 8, display=False)
+    np.random.seed(seed)
+    res = None
+    while not isinstance(res, np.ndarray):
+        res = decode_batch(emopia_net, dictionary, 1, sampler="numpy")[0]
+    assert reference[-1, TYPE] == 0
+    np.testing.assert_array_equal(res, reference)